@@ -6,16 +6,21 @@ import binascii
 import datetime
 import zoneinfo
 import uuid
-import string
-import itertools
-import json
-from hashlib import sha256
-from typing import Optional, Union, Tuple, Iterable, Iterator, Mapping
+import re
+import contextlib
+import secrets
+import contextvars
+import threading
+import functools
+from hashlib import blake2b, sha256
+from typing import Optional, Union, Tuple, Iterable, Iterator, Mapping, Dict
 import radicale.types
 from radicale.storage import BaseStorage, BaseCollection
 from radicale.log import logger
 from radicale import item as radicale_item
+from radicale.item import filter as radicale_filter
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 import xml.etree.ElementTree as ET
 
 from . import db
@@ -29,12 +34,43 @@ PLUGIN_CONFIG_SCHEMA = {
     },
 }
 
+# dialects whose insert supports ``ON CONFLICT ... DO UPDATE ... RETURNING``
+UPSERT_DIALECTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+# rows fetched per batch when streaming whole collections
+YIELD_PER = 500
+
+# sync token names are 64 lower case hex digits
+TOKEN_NAME_RE = re.compile(r'\A[0-9a-f]{64}\Z')
+
+
+def _random_hex_seeds(batch_size: int = 64) -> Iterator[str]:
+    # draws random bytes for many seeds at once, one syscall per batch
+    while True:
+        pool = os.urandom(16 * batch_size)
+        for i in range(0, len(pool), 16):
+            yield binascii.hexlify(pool[i:i + 16]).decode('ascii')
+
+
+def _chain_etag(history_etag: str, etag: str) -> str:
+    # same as radicale_item.get_etag(...).strip('"'), without quoting and stripping
+    return sha256(f'{history_etag}/{etag}'.encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_http_date(d: datetime.datetime) -> str:
+    # items of a collection often share modification times
+    return d.astimezone(tz=zoneinfo.ZoneInfo('GMT')).strftime('%a, %d %b %Y %H:%M:%S GMT')
+
 
 class Item(radicale_item.Item):
 
     def __init__(self, *args, last_modified: Optional[Union[str, datetime.datetime]] = None, **kwargs):
         if last_modified is not None and isinstance(last_modified, datetime.datetime):
-            last_modified = last_modified.astimezone(tz=zoneinfo.ZoneInfo('GMT')).strftime('%a, %d %b %Y %H:%M:%S GMT')
+            last_modified = _format_http_date(last_modified)
         super().__init__(*args, last_modified=last_modified, **kwargs)
 
 
@@ -57,124 +93,125 @@ class Collection(BaseCollection):
             collection=self,
             href=row.name,
             last_modified=row.modified,
-            text=row.data.decode(),
+            # radicale items need str, the stored data is always utf-8
+            text=row.data.decode('utf-8'),
         )
 
     def _get_multi(self, hrefs: Iterable[str], *, connection) -> Iterable[Tuple[str, Optional["radicale_item.Item"]]]:
-        item_table = self._storage._meta.tables['item']
         hrefs_ = list(hrefs)
         # hrefs_ = [(x,) for x in hrefs]
         if not hrefs_:
             return []
-        select_stmt = sa.select(
-            item_table.c,
-        ).select_from(
-            item_table,
-        ).where(
-            sa.and_(
-                item_table.c.collection_id == self._id,
-                item_table.c.name.in_(hrefs_)
-            ),
-        )
-        l = []
-        for row in connection.execute(select_stmt):
-            l += [(row.name, self._row_to_item(row))]
+        row_to_item = self._row_to_item
+        l = [(row.name, row_to_item(row)) for row in connection.execute(
+            self._storage._select_items_by_name_stmt, dict(cid=self._id, names=hrefs_))]
         hrefs_set = set(hrefs_)
-        hrefs_set_have = set([x[0] for x in l])
-        l += [(x, None) for x in (hrefs_set - hrefs_set_have)]
+        hrefs_set.difference_update(x[0] for x in l)
+        l += [(x, None) for x in hrefs_set]
         return l
 
     def get_multi(self, hrefs: Iterable[str]) -> Iterable[Tuple[str, Optional["radicale_item.Item"]]]:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin() as c:
             return self._get_multi(hrefs=hrefs, connection=c)
 
     def _get_all(self, *, connection) -> Iterator["radicale_item.Item"]:
-        item_table = self._storage._meta.tables['item']
-        select_stmt = sa.select(
-            item_table.c,
-        ).select_from(
-            item_table,
-        ).where(
-            item_table.c.collection_id == self._id,
-        )
-        for row in connection.execute(select_stmt):
-            yield self._row_to_item(row)
-
-    def _get_contains(self, text) -> Iterator["radicale_item.Item"]:
-        with self._storage._engine.begin() as c:
-            item_table = self._storage._meta.tables['item']
-            select_stmt = sa.select(
-                item_table.c,
-            ).select_from(
-                item_table,
-            ).where(
-                item_table.c.collection_id == self._id,
-            ).where(
-                item_table.c.data.contains(text.encode('utf-8')),
-            )
-            for row in c.execute(select_stmt):
-                yield self._row_to_item(row)
+        row_to_item = self._row_to_item
+        for row in connection.execute(self._storage._select_items_stmt, dict(cid=self._id)):
+            yield row_to_item(row)
 
     def get_all(self) -> Iterator["radicale_item.Item"]:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin() as c:
             for i in self._get_all(connection=c):
                 yield i
 
     def _upload(self, href: str, item: "radicale_item.Item", *, connection) -> "radicale_item.Item":
-        item_table = self._storage._meta.tables['item']
-
-        item_serialized = item.serialize().encode()
-        select_stmt = sa.select(
-            item_table.c,
-        ).select_from(
-            item_table,
-        ).where(
-            sa.and_(
-                item_table.c.collection_id == self._id,
-                item_table.c.name == href,
-            ),
-        )
-        insert_stmt = sa.insert(
-            item_table,
-        ).values(
-            collection_id=self._id,
-            name=href,
-            data=item_serialized,
-        )
-        update_stmt = sa.update(
-            item_table,
-        ).values(
-            data=item_serialized,
-        ).where(
-            sa.and_(
-                item_table.c.collection_id == self._id,
-                item_table.c.name == href,
-            ),
-        )
-        if connection.execute(select_stmt).one_or_none() is None:
-            connection.execute(insert_stmt)
-            self._storage._collection_updated(self._id, connection=connection)
+        item_table = self._storage._item_table
+
+        # serialize() caches the text on the item, reuse it for the result
+        item_text = item.serialize()
+        item_serialized = item_text.encode()
+        if self._storage._upsert_item_stmt is not None:
+            modified = connection.execute(self._storage._upsert_item_stmt, dict(
+                b_cid=self._id,
+                b_name=href,
+                b_data=item_serialized,
+                b_modified=datetime.datetime.now(),
+            )).scalar_one()
+        elif self._storage._engine.dialect.name in ('mysql', 'mariadb'):
+            # no RETURNING, so the modification time is set explicitly
+            modified = datetime.datetime.now()
+            insert_stmt = mysql.insert(
+                item_table,
+            ).values(
+                collection_id=self._id,
+                name=href,
+                modified=modified,
+                data=item_serialized,
+            )
+            connection.execute(insert_stmt.on_duplicate_key_update(
+                modified=modified,
+                data=insert_stmt.inserted.data,
+            ))
         else:
-            connection.execute(update_stmt)
-            self._storage._item_updated(self._id, href, connection=connection)
+            # without RETURNING the modification time is set explicitly
+            modified = datetime.datetime.now()
+            select_stmt = sa.select(
+                sa.exists().where(
+                    sa.and_(
+                        item_table.c.collection_id == self._id,
+                        item_table.c.name == href,
+                    ),
+                ),
+            )
+            insert_stmt = sa.insert(
+                item_table,
+            ).values(
+                collection_id=self._id,
+                name=href,
+                modified=modified,
+                data=item_serialized,
+            )
+            update_stmt = sa.update(
+                item_table,
+            ).values(
+                modified=modified,
+                data=item_serialized,
+            ).where(
+                sa.and_(
+                    item_table.c.collection_id == self._id,
+                    item_table.c.name == href,
+                ),
+            )
+            if not connection.execute(select_stmt).scalar():
+                connection.execute(insert_stmt)
+            else:
+                connection.execute(update_stmt)
+        self._storage._collection_updated(self._id, connection=connection)
         self._update_history_etag(href, item, connection=connection)
-        res = list(self._get_multi([href], connection=connection))[0][1]
-        assert res is not None
-        return res
+        self._index_items({href: item}, connection=connection)
+        return Item(
+            collection=self,
+            href=href,
+            last_modified=modified,
+            text=item_text,
+            etag=item.etag,
+        )
 
     def upload(self, href: str, item: "radicale_item.Item") -> "radicale_item.Item":
-        with self._storage._engine.begin() as c:
+        with self._storage._begin(atomic=True) as c:
             return self._upload(href, item, connection=c)
 
     def _delete(self, *, connection, href: Optional[str] = None) -> None:
-        collection_table = self._storage._meta.tables['collection']
-        item_table = self._storage._meta.tables['item']
+        collection_table = self._storage._collection_table
+        item_table = self._storage._item_table
         if href is None:
             delete_stmt = sa.delete(
                 collection_table,
             ).where(
                 collection_table.c.id == self._id,
             )
+            # SQLite does not enforce the cascade by default
+            connection.execute(self._storage._delete_collection_item_index_stmt, dict(cid=self._id))
         else:
             delete_stmt = sa.delete(
                 item_table,
@@ -185,187 +222,244 @@ class Collection(BaseCollection):
                 ),
             )
             self._storage._item_updated(self._id, href, connection=connection)
+            # SQLite does not enforce the cascade by default
+            connection.execute(self._storage._delete_item_index_stmt, dict(b_cid=self._id, b_name=href))
         connection.execute(delete_stmt)
 
     def delete(self, href: Optional[str] = None) -> None:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin(atomic=True) as c:
             return self._delete(connection=c, href=href)
 
     def _get_meta(self, *, connection, key: Optional[str] = None) -> Union[Mapping[str, str], Optional[str]]:
-        collection_metadata = self._storage._meta.tables['collection_metadata']
-        select_meta = sa.select(
-            collection_metadata.c.key,
-            collection_metadata.c.value,
-        ).select_from(
-            collection_metadata,
-        ).where(
-            collection_metadata.c.collection_id == self._id,
-        )
+        cache = self._storage._request_meta.get()
+        if cache is not None:
+            # radicale reads single keys many times per request, load them all once
+            metadata = cache.get(self._id)
+            if metadata is None:
+                metadata = cache[self._id] = {row.key: row.value for row in connection.execute(
+                    self._storage._select_meta_stmt, dict(cid=self._id))}
+            if key is not None:
+                return metadata.get(key)
+            return dict(metadata)
         if key is not None:
-            select_meta = select_meta.where(
-                collection_metadata.c.key == key,
-            )
+            select_meta = self._storage._select_meta_by_key_stmt
+        else:
+            select_meta = self._storage._select_meta_stmt
         metadata = {}
-        for row in connection.execute(select_meta):
+        for row in connection.execute(select_meta, dict(cid=self._id, key=key)):
             metadata[row.key] = row.value
         if key is not None:
             return metadata.get(key)
         return metadata
 
     def get_meta(self, key: Optional[str] = None) -> Union[Mapping[str, str], Optional[str]]:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin() as c:
             return self._get_meta(connection=c, key=key)
 
     def _set_meta(self, props: Mapping[str, str], *, connection) -> None:
-        collection_metadata = self._storage._meta.tables['collection_metadata']
+        collection_metadata = self._storage._collection_metadata_table
         delete_stmt = sa.delete(
             collection_metadata,
         ).where(
             collection_metadata.c.collection_id == self._id,
         )
-        insert_stmt = sa.insert(
-            collection_metadata,
-        ).values([dict(collection_id=self._id, key=k, value=v) for k, v in props.items()])
         connection.execute(delete_stmt)
-        connection.execute(insert_stmt)
+        if props:
+            connection.execute(
+                sa.insert(collection_metadata),
+                [dict(collection_id=self._id, key=k, value=v) for k, v in props.items()],
+            )
         self._storage._collection_updated(self._id, connection=connection)
 
     def set_meta(self, props: Mapping[str, str]) -> None:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin(atomic=True) as c:
             return self._set_meta(props, connection=c)
 
     def _last_modified(self, *, connection) -> str:
-        collection = self._storage._meta.tables['collection']
-        select_stmt = sa.select(
-            collection.c.modified,
-        ).select_from(
-            collection,
-        ).where(
-            collection.c.id == self._id,
-        )
-        c = connection.execute(select_stmt).one()
-        return c.modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        cache = self._storage._request_last_modified.get()
+        if cache is not None and self._id in cache:
+            return cache[self._id]
+        c = connection.execute(self._storage._select_collection_modified_stmt, dict(cid=self._id)).one()
+        last_modified = c.modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        if cache is not None:
+            cache[self._id] = last_modified
+        return last_modified
 
     @property
     def last_modified(self):
-        with self._storage._engine.begin() as c:
+        with self._storage._begin() as c:
             return self._last_modified(connection=c)
 
     def _update_history_etag(self, href: str, item: Optional["radicale_item.Item"], *, connection) -> str:
-        item_history_table = self._storage._meta.tables['item_history']
-        select_etag_stmt = sa.select(
-            item_history_table.c,
-        ).select_from(
-            item_history_table,
-        ).where(
-            sa.and_(
-                item_history_table.c.collection_id == self._id,
-                item_history_table.c.name == href,
-            ),
-        )
-        exists: bool
-        item_history = connection.execute(select_etag_stmt).one_or_none()
+        item_history = connection.execute(
+            self._storage._select_history_stmt, dict(cid=self._id, name=href)).one_or_none()
         if item_history is not None:
-            exists = True
             cache_etag = item_history.etag
             history_etag = item_history.history_etag
         else:
-            exists = False
             cache_etag = ''
-            history_etag = binascii.hexlify(os.urandom(16)).decode('ascii')
+            history_etag = secrets.token_hex(16)
         etag = item.etag if item else ''
         if etag != cache_etag:
-            history_etag = radicale_item.get_etag(history_etag + '/' + etag).strip('\"')
-            if exists:
-                upsert = sa.update(
-                    item_history_table,
-                ).values(
-                    etag=etag,
-                    history_etag=history_etag,
-                ).where(
-                    sa.and_(
-                        item_history_table.c.collection_id == self._id,
-                        item_history_table.c.name == href,
-                    ),
-                )
+            history_etag = _chain_etag(history_etag, etag)
+            if item_history is not None:
+                self._write_history_etags([], [
+                    dict(b_cid=self._id, b_name=href, b_etag=etag, b_history_etag=history_etag)
+                ], connection=connection)
             else:
-                upsert = sa.insert(
-                    item_history_table,
-                ).values(
-                    collection_id=self._id,
-                    name=href,
-                    etag=etag,
-                    history_etag=history_etag,
-                )
-            connection.execute(upsert)
+                self._write_history_etags([
+                    dict(collection_id=self._id, name=href, etag=etag, history_etag=history_etag)
+                ], [], connection=connection)
         return history_etag
 
-    def _get_deleted_history_refs(self, *, connection):
-        item_table = self._storage._meta.tables['item']
-        item_history_table = self._storage._meta.tables['item_history']
-        select_stmt = sa.select(
+    def _write_history_etags(self, inserts: Iterable[Mapping], updates: Iterable[Mapping], *, connection) -> None:
+        # write back changed history entries in bulk
+        if inserts:
+            connection.execute(sa.insert(self._storage._item_history_table), inserts)
+        if updates:
+            connection.execute(self._storage._update_history_stmt, updates)
+
+    def _update_history_etags(self, items: Mapping[str, "radicale_item.Item"], *, connection) -> None:
+        # bulk version of _update_history_etag for many new items
+        item_history_table = self._storage._item_history_table
+        select_history_stmt = sa.select(
             item_history_table.c.name,
+            item_history_table.c.etag,
+            item_history_table.c.history_etag,
         ).select_from(
-            item_history_table.join(
-                item_table,
-                sa.and_(
-                    item_history_table.c.collection_id == item_table.c.collection_id,
-                    item_history_table.c.name == item_table.c.name,
-                ),
-                isouter=True,
-            ),
+            item_history_table,
         ).where(
-            sa.and_(
-                item_history_table.c.collection_id == self._id,
-                item_table.c.id == None,
-            ),
+            item_history_table.c.collection_id == self._id,
         )
-        for row in connection.execute(select_stmt):
-            yield row.name
+        history = {row.name: row for row in connection.execute(select_history_stmt)}
+        history_inserts = []
+        history_updates = []
+        history_seeds = _random_hex_seeds()
+        for href, item in items.items():
+            item_history = history.get(href)
+            if item_history is not None:
+                if item.etag == item_history.etag:
+                    continue
+                history_etag = _chain_etag(item_history.history_etag, item.etag)
+                history_updates.append(dict(b_cid=self._id, b_name=href, b_etag=item.etag, b_history_etag=history_etag))
+            else:
+                history_etag = _chain_etag(next(history_seeds), item.etag)
+                history_inserts.append(dict(collection_id=self._id, name=href, etag=item.etag, history_etag=history_etag))
+        self._write_history_etags(history_inserts, history_updates, connection=connection)
+
+    def _upload_many(self, items: Mapping[str, "radicale_item.Item"], *, connection) -> None:
+        # bulk insert into a collection known to be empty
+        item_table = self._storage._item_table
+        # one timestamp for the whole load instead of calling the column default per row
+        modified = datetime.datetime.now()
+        rows = [dict(collection_id=self._id, name=href, modified=modified, data=item.serialize().encode())
+                for href, item in items.items()]
+        for i in range(0, len(rows), 10_000):
+            connection.execute(sa.insert(item_table), rows[i:i + 10_000])
+        self._update_history_etags(items, connection=connection)
+        self._index_items(items, connection=connection)
+        self._storage._collection_updated(self._id, connection=connection)
+
+    def _index_items(self, items: Mapping[str, "radicale_item.Item"], *, connection) -> None:
+        # component and time range let get_filtered() skip items in SQL,
+        # the uid serves has_uid()
+        rows = [dict(
+            b_cid=self._id,
+            b_name=href,
+            b_component=item.component_name,
+            b_time_start=item.time_range[0],
+            b_time_end=item.time_range[1],
+            b_uid=item.uid,
+        ) for href, item in items.items()]
+        if not rows:
+            return
+        connection.execute(self._storage._delete_item_index_stmt, rows)
+        connection.execute(self._storage._insert_item_index_stmt, rows)
 
     def _delete_history_refs(self, *, connection):
-        item_history_table = self._storage._meta.tables['item_history']
-        delete_stmt = sa.delete(
-            item_history_table,
-        ).where(
-            sa.and_(
-                item_history_table.c.href.in_(list(self._get_deleted_history_refs(connection=connection))),
-                item_history_table.c.collection_id == self._id,
-                item_history_table.c.modified < (datetime.datetime.now() - datetime.timedelta(
-                    seconds=self._storage.configuration.get('storage', 'max_sync_token_age')))
-            ),
-        )
-        connection.execute(delete_stmt)
+        # drop history entries of items deleted longer than max_sync_token_age
+        # ago, and tokens not issued for as long together with their state
+        cutoff = datetime.datetime.now() - self._storage._max_sync_token_age
+        connection.execute(self._storage._delete_history_refs_stmt, dict(cid=self._id, cutoff=cutoff))
+        connection.execute(self._storage._delete_state_tokens_stmt, dict(cid=self._id, cutoff=cutoff))
+        connection.execute(self._storage._delete_state_entries_stmt, dict(cid=self._id))
 
     def _sync(self, *, connection, old_token: str = '') -> Tuple[str, Iterable[str]]:
         # Parts of this method have been taken from
         # https://github.com/Kozea/Radicale/blob/6a56a6026f6ec463d6eb77da29e03c48c0c736c6/radicale/storage/multifilesystem/sync.py
         _prefix = 'http://radicale.org/ns/sync/'
-        collection_state_table = self._storage._meta.tables['collection_state']
-
-        def check_token_name(token_name: str) -> bool:
-            if len(token_name) != 64:
-                return False
-            for c in token_name:
-                if c not in string.hexdigits.lower():
-                    return False
-            return True
+        collection_state_entry_table = self._storage._collection_state_entry_table
 
         old_token_name = ''
         if old_token:
             if not old_token.startswith(_prefix):
                 raise ValueError(f'Malformed token: {old_token}')
             old_token_name = old_token[len(_prefix):]
-            if not check_token_name(old_token_name):
+            if not TOKEN_NAME_RE.match(old_token_name):
                 raise ValueError(f'Malformed token: {old_token}')
+            if not connection.execute(self._storage._select_state_token_exists_stmt,
+                                      dict(cid=self._id, name=old_token_name)).scalar():
+                raise ValueError(f'Token not found: {old_token}')
+
+        # join every item with its history and add the history entries
+        # without an item (deleted items), all in a single query
+        item_table = self._storage._item_table
+        item_history_table = self._storage._item_history_table
+        select_items = sa.select(
+            item_table.c.name,
+            item_table.c.modified,
+            item_table.c.data,
+            item_history_table.c.id.label('history_id'),
+            item_history_table.c.etag,
+            item_history_table.c.history_etag,
+            sa.literal('item', sa.String(16)).label('type_'),
+        ).select_from(
+            item_table.join(
+                item_history_table,
+                sa.and_(
+                    item_history_table.c.collection_id == item_table.c.collection_id,
+                    item_history_table.c.name == item_table.c.name,
+                ),
+                isouter=True,
+            ),
+        ).where(
+            item_table.c.collection_id == self._id,
+        )
+        select_deleted = sa.select(
+            item_history_table.c.name,
+            sa.literal(None, sa.DateTime()).label('modified'),
+            sa.literal(None, sa.LargeBinary()).label('data'),
+            item_history_table.c.id.label('history_id'),
+            item_history_table.c.etag,
+            item_history_table.c.history_etag,
+            sa.literal('deleted', sa.String(16)).label('type_'),
+        ).select_from(
+            item_history_table,
+        ).where(
+            sa.and_(
+                item_history_table.c.collection_id == self._id,
+                ~sa.exists().where(
+                    sa.and_(
+                        item_table.c.collection_id == item_history_table.c.collection_id,
+                        item_table.c.name == item_history_table.c.name,
+                    ),
+                ),
+            ),
+        )
 
         # compute new state
         state = {}
-        token_name_hash = sha256()
-        for href, item in itertools.chain(
-                ((item.href, item) for item in self._get_all(connection=connection)),
-                ((href, None) for href in self._get_deleted_history_refs(connection=connection))
-        ):
+        history_inserts = []
+        history_updates = []
+        history_seeds = _random_hex_seeds()
+        select_stmt = sa.union_all(
+            select_items,
+            select_deleted,
+        ).execution_options(
+            yield_per=YIELD_PER,
+        )
+        for row in connection.execute(select_stmt):
+            href = row.name
             assert isinstance(href, str)
             if href in state:
                 # we don't want to overwrite states
@@ -373,81 +467,155 @@ class Collection(BaseCollection):
                 # which doesn't store the items itself, but 
                 # derives them from another one
                 continue
-            history_etag = self._update_history_etag(href, item, connection=connection)
+            item = self._row_to_item(row) if row.type_ == 'item' else None
+            if row.history_id is not None:
+                cache_etag = row.etag
+                history_etag = row.history_etag
+            else:
+                cache_etag = ''
+                history_etag = next(history_seeds)
+            etag = item.etag if item else ''
+            if etag != cache_etag:
+                history_etag = _chain_etag(history_etag, etag)
+                if row.history_id is not None:
+                    history_updates.append(dict(b_cid=self._id, b_name=href, b_etag=etag, b_history_etag=history_etag))
+                else:
+                    history_inserts.append(dict(collection_id=self._id, name=href, etag=etag, history_etag=history_etag))
             state[href] = history_etag
-            token_name_hash.update((href + '/' + history_etag).encode())
-        token_name = token_name_hash.hexdigest()
+
+        self._write_history_etags(history_inserts, history_updates, connection=connection)
+        # hash in href order, the row order of the query is not defined;
+        # blake2b is faster than sha256 in CPython, 32 bytes keep the 64 hex digit token names
+        token_name = blake2b(
+            b'\n'.join(f'{href}/{history_etag}'.encode() for href, history_etag in sorted(state.items())),
+            digest_size=32,
+        ).hexdigest()
         token = _prefix + token_name
 
         # if new state hasn't changed: dont send any updates
         if token_name == old_token_name:
             return token, ()
 
-        # load old state
-        old_state = {}
-        if old_token_name:
-            select_stmt = sa.select(
-                collection_state_table.c,
-            ).select_from(
-                collection_state_table,
-            ).where(
-                sa.and_(
-                    collection_state_table.c.collection_id == self._id,
-                    collection_state_table.c.name == old_token_name,
-                ),
+        # store new state, one row per href, unless it is known already;
+        # issuing a known token again keeps it from expiring
+        modified = datetime.datetime.now()
+        new_token = not connection.execute(self._storage._update_state_token_stmt, dict(
+            b_cid=self._id, b_name=token_name, b_modified=modified)).rowcount
+        if new_token:
+            # a concurrent sync of the same collection may store the same state
+            connection.execute(
+                self._storage._insert_ignore(self._storage._collection_state_token_table),
+                dict(collection_id=self._id, name=token_name, modified=modified),
             )
-            state_row = connection.execute(select_stmt).one_or_none()
-            old_state = json.loads(state_row.state.decode()) if state_row is not None else {}
+            if state:
+                connection.execute(
+                    self._storage._insert_ignore(collection_state_entry_table),
+                    [dict(collection_id=self._id, name=token_name, href=href, history_etag=history_etag)
+                     for href, history_etag in state.items()],
+                )
 
-        # store new state
-        select_new_state = sa.select(
-            collection_state_table.c,
-        ).select_from(
-            collection_state_table,
+        # compare new and old state in the database, so the old state
+        # never has to be loaded: an href changed if its history etag
+        # differs from the old state or if it is no longer part of it
+        new_entry = collection_state_entry_table.alias('new_entry')
+        old_entry = collection_state_entry_table.alias('old_entry')
+        select_changed = sa.select(
+            new_entry.c.href,
         ).where(
-            collection_state_table.c.collection_id == self._id,
-            collection_state_table.c.name == token_name,
+            sa.and_(
+                new_entry.c.collection_id == self._id,
+                new_entry.c.name == token_name,
+                ~sa.exists().where(
+                    sa.and_(
+                        old_entry.c.collection_id == self._id,
+                        old_entry.c.name == old_token_name,
+                        old_entry.c.href == new_entry.c.href,
+                        old_entry.c.history_etag == new_entry.c.history_etag,
+                    ),
+                ),
+            ),
         )
-        if connection.execute(select_new_state).one_or_none() is None:
-            insert_stmt = sa.insert(
-                collection_state_table,
-            ).values(
-                collection_id=self._id,
-                name=token_name,
-                state=json.dumps(state).encode(),
-            )
-            connection.execute(insert_stmt)
+        select_removed = sa.select(
+            old_entry.c.href,
+        ).where(
+            sa.and_(
+                old_entry.c.collection_id == self._id,
+                old_entry.c.name == old_token_name,
+                ~sa.exists().where(
+                    sa.and_(
+                        new_entry.c.collection_id == self._id,
+                        new_entry.c.name == token_name,
+                        new_entry.c.href == old_entry.c.href,
+                    ),
+                ),
+            ),
+        )
+        changes = [row.href for row in connection.execute(sa.union_all(select_changed, select_removed))]
 
-        changes = []
-        for href, history_etag in state.items():
-            if history_etag != old_state.get(href):
-                changes += [href]
-        for href, history_etag in old_state.items():
-            if href not in state:
-                changes += [href]
+        if new_token:
+            # clean up old history and tokens, like radicale does when storing a new token
+            self._delete_history_refs(connection=connection)
 
         return token, changes
 
     def sync(self, old_token: str = '') -> Tuple[str, Iterable[str]]:
-        with self._storage._engine.begin() as c:
+        with self._storage._begin(atomic=True) as c:
             return self._sync(connection=c, old_token=old_token)
 
+    def _get_filtered(self, filters: Iterable[ET.Element], *, connection
+                      ) -> Iterator[Tuple["radicale_item.Item", bool]]:
+        # same semantics as BaseCollection.get_filtered(), but the component
+        # and time range prefilter runs in SQL for indexed items
+        if not self.tag:
+            return
+        tag, start, end, simple = radicale_filter.simplify_prefilters(filters, self.tag)
+        if tag is not None:
+            select_stmt = self._storage._select_filtered_items_by_tag_stmt
+        else:
+            select_stmt = self._storage._select_filtered_items_stmt
+        unindexed = {}
+        for row in connection.execute(select_stmt, dict(cid=self._id, tag=tag, start=start, end=end)):
+            if row.time_start is not None:
+                item = Item(
+                    collection=self,
+                    href=row.name,
+                    last_modified=row.modified,
+                    text=row.data.decode('utf-8'),
+                    component_name=row.component,
+                    time_range=(row.time_start, row.time_end),
+                )
+            else:
+                # stored before the index existed
+                item = unindexed[row.name] = self._row_to_item(row)
+                if tag is not None and tag != item.component_name:
+                    continue
+                istart, iend = item.time_range
+                if istart >= end or iend <= start:
+                    continue
+            istart, iend = item.time_range
+            yield item, simple and (start <= istart or iend <= end)
+        # index the parsed items, so they are not parsed again
+        self._index_items(unindexed, connection=connection)
+
     def get_filtered(self, filters: Iterable[ET.Element]
                      ) -> Iterable[Tuple["radicale_item.Item", bool]]:
-        if (len(filters) == 1 and len(filters[0]) == 1 and len(filters[0][0]) == 1\
-                and "text-match" in filters[0][0][0].tag
-                and filters[0][0][0].get('match-type') in ["contains", "equals"]):
-            for item in self._get_contains(filters[0][0][0].text):
-                yield item, False
-        else:
-            yield from super().get_filtered(filters)
+        # text matches are left to radicale: the stored text is folded and
+        # escaped, and matched case-insensitively, so LIKE can't prefilter it
+        with self._storage._begin() as c:
+            yield from self._get_filtered(filters, connection=c)
+
+    def _has_uid(self, uid: str, *, connection) -> bool:
+        if connection.execute(self._storage._select_uid_exists_stmt, dict(cid=self._id, uid=uid)).scalar():
+            return True
+        # items stored before the index existed, indexed once they are parsed
+        unindexed = {row.name: self._row_to_item(row)
+                     for row in connection.execute(self._storage._select_unindexed_items_stmt, dict(cid=self._id))}
+        self._index_items(unindexed, connection=connection)
+        return any(item.uid == uid for item in unindexed.values())
 
     def has_uid(self, uid: str) -> bool:
-        items = self._get_contains(uid)
-        for item in items:
-            if item.uid == uid:
-                return True
-        return False
+        with self._storage._begin() as c:
+            return self._has_uid(uid, connection=c)
 
 
 def create_collection(*args, **kwargs) -> Collection:
@@ -460,7 +628,293 @@ class Storage(BaseStorage):
     def __init__(self, configuration: "radicale.config.Configuration"):
         super().__init__(configuration)
         self._meta = db.create_meta()
+        self._collection_table = self._meta.tables['collection']
+        self._collection_metadata_table = self._meta.tables['collection_metadata']
+        self._collection_state_token_table = self._meta.tables['collection_state_token']
+        self._collection_state_entry_table = self._meta.tables['collection_state_entry']
+        self._item_table = self._meta.tables['item']
+        self._item_history_table = self._meta.tables['item_history']
+        self._item_index_table = self._meta.tables['item_index']
         self._engine, self._root_collection = db.create(self.configuration.get('storage', 'url'), self._meta)
+        self._dialect_insert = UPSERT_DIALECTS.get(self._engine.dialect.name)
+        # transactions that write lock sqlite up front, see db.create()
+        self._write_engine = self._engine.execution_options(immediate=True)
+        self._max_sync_token_age = datetime.timedelta(
+            seconds=self.configuration.get('storage', 'max_sync_token_age'))
+        self._request_connection: contextvars.ContextVar[Optional[sa.engine.Connection]] = contextvars.ContextVar(
+            'request_connection', default=None)
+        # all threads share the connection of an in-memory database, so
+        # their transactions must not overlap
+        self._transaction_lock: contextlib.AbstractContextManager = (
+            threading.RLock() if isinstance(self._engine.pool, sa.pool.StaticPool) else contextlib.nullcontext())
+        # the connection of a transaction a thread opened outside of a request
+        self._thread_connection = threading.local()
+        # collection metadata and formatted modification times, valid for one request
+        self._request_meta: contextvars.ContextVar[Optional[Dict[uuid.UUID, Dict[str, str]]]] = contextvars.ContextVar(
+            'request_meta', default=None)
+        self._request_last_modified: contextvars.ContextVar[Optional[Dict[uuid.UUID, str]]] = contextvars.ContextVar(
+            'request_last_modified', default=None)
+
+        # statements on the hot path are built once with bind parameters,
+        # so every call hits the compiled cache without rebuilding them
+        item_table = self._item_table
+        self._select_items_stmt = sa.select(
+            item_table.c,
+        ).select_from(
+            item_table,
+        ).where(
+            item_table.c.collection_id == sa.bindparam('cid'),
+        )
+        self._select_items_by_name_stmt = self._select_items_stmt.where(
+            item_table.c.name.in_(sa.bindparam('names', expanding=True)),
+        )
+        self._select_item_stmt = self._select_items_stmt.where(
+            item_table.c.name == sa.bindparam('name'),
+        )
+        # whole collections are streamed in batches to bound memory
+        self._select_items_stmt = self._select_items_stmt.execution_options(
+            yield_per=YIELD_PER,
+        )
+        collection_table = self._collection_table
+        self._select_child_collections_stmt = sa.select(
+            collection_table.c.id,
+            collection_table.c.name,
+        ).select_from(
+            collection_table,
+        ).where(
+            collection_table.c.parent_id == sa.bindparam('pid'),
+        ).execution_options(
+            yield_per=YIELD_PER,
+        )
+        self._discover_walk_stmts: Dict[int, sa.Select] = {}
+        self._upsert_item_stmt = None
+        if self._dialect_insert is not None:
+            insert_stmt = self._dialect_insert(
+                item_table,
+            ).values(
+                collection_id=sa.bindparam('b_cid'),
+                name=sa.bindparam('b_name'),
+                data=sa.bindparam('b_data'),
+            )
+            # onupdate defaults are not applied to ON CONFLICT updates
+            self._upsert_item_stmt = insert_stmt.on_conflict_do_update(
+                index_elements=[item_table.c.collection_id, item_table.c.name],
+                set_=dict(
+                    data=insert_stmt.excluded.data,
+                    modified=sa.bindparam('b_modified'),
+                ),
+            ).returning(
+                item_table.c.modified,
+            )
+        self._update_item_modified_stmt = sa.update(
+            item_table,
+        ).values(
+            modified=sa.bindparam('b_modified'),
+        ).where(
+            sa.and_(
+                item_table.c.collection_id == sa.bindparam('b_cid'),
+                item_table.c.name == sa.bindparam('b_name'),
+            ),
+        ).returning(
+            item_table.c.collection_id,
+        )
+        self._update_collection_modified_stmt = sa.update(
+            collection_table,
+        ).values(
+            modified=sa.bindparam('b_modified'),
+        ).where(
+            collection_table.c.id.in_(sa.bindparam('ids', expanding=True)),
+        )
+        self._select_collection_modified_stmt = sa.select(
+            collection_table.c.modified,
+        ).select_from(
+            collection_table,
+        ).where(
+            collection_table.c.id == sa.bindparam('cid'),
+        )
+        collection_metadata_table = self._collection_metadata_table
+        self._select_meta_stmt = sa.select(
+            collection_metadata_table.c.key,
+            collection_metadata_table.c.value,
+        ).select_from(
+            collection_metadata_table,
+        ).where(
+            collection_metadata_table.c.collection_id == sa.bindparam('cid'),
+        )
+        self._select_meta_by_key_stmt = self._select_meta_stmt.where(
+            collection_metadata_table.c.key == sa.bindparam('key'),
+        )
+        item_history_table = self._item_history_table
+        self._select_history_stmt = sa.select(
+            item_history_table.c.name,
+            item_history_table.c.etag,
+            item_history_table.c.history_etag,
+        ).select_from(
+            item_history_table,
+        ).where(
+            sa.and_(
+                item_history_table.c.collection_id == sa.bindparam('cid'),
+                item_history_table.c.name == sa.bindparam('name'),
+            ),
+        )
+        item_index_table = self._item_index_table
+        select_item_id = sa.select(
+            item_table.c.id,
+        ).where(
+            sa.and_(
+                item_table.c.collection_id == sa.bindparam('b_cid'),
+                item_table.c.name == sa.bindparam('b_name'),
+            ),
+        )
+        self._delete_item_index_stmt = sa.delete(
+            item_index_table,
+        ).where(
+            item_index_table.c.item_id.in_(select_item_id.scalar_subquery()),
+        )
+        self._delete_collection_item_index_stmt = sa.delete(
+            item_index_table,
+        ).where(
+            item_index_table.c.item_id.in_(
+                sa.select(item_table.c.id).where(item_table.c.collection_id == sa.bindparam('cid')),
+            ),
+        )
+        # concurrent reads may index the same item stored before the index existed
+        self._insert_item_index_stmt = self._insert_ignore(
+            item_index_table,
+        ).from_select(
+            ['item_id', 'component', 'time_start', 'time_end', 'uid'],
+            select_item_id.add_columns(
+                sa.bindparam('b_component', type_=sa.String()),
+                sa.bindparam('b_time_start', type_=sa.BigInteger()),
+                sa.bindparam('b_time_end', type_=sa.BigInteger()),
+                sa.bindparam('b_uid', type_=sa.String()),
+            ),
+        )
+        self._select_uid_exists_stmt = sa.select(
+            sa.exists().where(
+                sa.and_(
+                    item_table.c.id == item_index_table.c.item_id,
+                    item_table.c.collection_id == sa.bindparam('cid'),
+                    item_index_table.c.uid == sa.bindparam('uid'),
+                ),
+            ),
+        )
+        self._select_unindexed_items_stmt = sa.select(
+            item_table.c,
+        ).select_from(
+            item_table.outerjoin(
+                item_index_table,
+                item_index_table.c.item_id == item_table.c.id,
+            ),
+        ).where(
+            sa.and_(
+                item_table.c.collection_id == sa.bindparam('cid'),
+                item_index_table.c.item_id.is_(None),
+            ),
+        ).execution_options(
+            yield_per=YIELD_PER,
+        )
+        # items without an index row are always returned and checked in Python
+        self._select_filtered_items_stmt = sa.select(
+            item_table.c,
+            item_index_table.c.component,
+            item_index_table.c.time_start,
+            item_index_table.c.time_end,
+        ).select_from(
+            item_table.outerjoin(
+                item_index_table,
+                item_index_table.c.item_id == item_table.c.id,
+            ),
+        ).where(
+            sa.and_(
+                item_table.c.collection_id == sa.bindparam('cid'),
+                sa.or_(
+                    item_index_table.c.item_id.is_(None),
+                    sa.and_(
+                        item_index_table.c.time_start < sa.bindparam('end'),
+                        item_index_table.c.time_end > sa.bindparam('start'),
+                    ),
+                ),
+            ),
+        )
+        self._select_filtered_items_by_tag_stmt = self._select_filtered_items_stmt.where(
+            sa.or_(
+                item_index_table.c.item_id.is_(None),
+                item_index_table.c.component == sa.bindparam('tag'),
+            ),
+        ).execution_options(
+            yield_per=YIELD_PER,
+        )
+        self._select_filtered_items_stmt = self._select_filtered_items_stmt.execution_options(
+            yield_per=YIELD_PER,
+        )
+        self._delete_history_refs_stmt = sa.delete(
+            item_history_table,
+        ).where(
+            sa.and_(
+                item_history_table.c.collection_id == sa.bindparam('cid'),
+                item_history_table.c.modified < sa.bindparam('cutoff'),
+                ~sa.exists().where(
+                    sa.and_(
+                        item_table.c.collection_id == item_history_table.c.collection_id,
+                        item_table.c.name == item_history_table.c.name,
+                    ),
+                ),
+            ),
+        )
+        collection_state_token_table = self._collection_state_token_table
+        collection_state_entry_table = self._collection_state_entry_table
+        self._select_state_token_exists_stmt = sa.select(
+            sa.exists().where(
+                sa.and_(
+                    collection_state_token_table.c.collection_id == sa.bindparam('cid'),
+                    collection_state_token_table.c.name == sa.bindparam('name'),
+                ),
+            ),
+        )
+        self._update_state_token_stmt = sa.update(
+            collection_state_token_table,
+        ).values(
+            modified=sa.bindparam('b_modified'),
+        ).where(
+            sa.and_(
+                collection_state_token_table.c.collection_id == sa.bindparam('b_cid'),
+                collection_state_token_table.c.name == sa.bindparam('b_name'),
+            ),
+        )
+        self._delete_state_tokens_stmt = sa.delete(
+            collection_state_token_table,
+        ).where(
+            sa.and_(
+                collection_state_token_table.c.collection_id == sa.bindparam('cid'),
+                collection_state_token_table.c.modified < sa.bindparam('cutoff'),
+            ),
+        )
+        # state rows of expired tokens, and of tokens stored before tokens were recorded
+        self._delete_state_entries_stmt = sa.delete(
+            collection_state_entry_table,
+        ).where(
+            sa.and_(
+                collection_state_entry_table.c.collection_id == sa.bindparam('cid'),
+                ~sa.exists().where(
+                    sa.and_(
+                        collection_state_token_table.c.collection_id == collection_state_entry_table.c.collection_id,
+                        collection_state_token_table.c.name == collection_state_entry_table.c.name,
+                    ),
+                ),
+            ),
+        )
+        self._update_history_stmt = sa.update(
+            item_history_table,
+        ).values(
+            etag=sa.bindparam('b_etag'),
+            history_etag=sa.bindparam('b_history_etag'),
+        ).where(
+            sa.and_(
+                item_history_table.c.collection_id == sa.bindparam('b_cid'),
+                item_history_table.c.name == sa.bindparam('b_name'),
+            ),
+        )
 
     def _split_path(self, path: str):
         path_parts = path.split('/')
@@ -470,100 +924,102 @@ class Storage(BaseStorage):
             path_parts = path_parts[:-1]
         return path_parts
 
-    def _get_collection(self, id, *, connection) -> "BaseCollection":
-        collection_table = self._meta.tables['collection']
-        select_stmt = sa.select(
-            collection_table.c,
-        ).where(
-            collection_table.c.id == id,
-        )
-        row = connection.execute(select_stmt).one()
-        # TODO: path
-        return create_collection(self, id, '')
-
-    def _collection_updated(self, collection_id, *, connection):
-        collection_table = self._meta.tables['collection']
-        connection.execute(sa.update(
-            collection_table,
-        ).values(
-            modified=datetime.datetime.now(),
-        ).where(
-            collection_table.c.id == collection_id,
+    def _collection_updated(self, *collection_ids, connection):
+        connection.execute(self._update_collection_modified_stmt, dict(
+            ids=collection_ids,
+            b_modified=datetime.datetime.now(),
         ))
+        self._forget_collections(*collection_ids)
+
+    def _forget_collections(self, *collection_ids):
+        # drop request cache entries of changed collections
+        for cache in (self._request_meta.get(), self._request_last_modified.get()):
+            if cache:
+                for collection_id in collection_ids:
+                    cache.pop(collection_id, None)
 
     def _item_updated(self, collection_id: uuid.UUID, href: str, *, connection):
-        item_table = self._meta.tables['item']
-        item_row = connection.execute(sa.update(
-            item_table,
-        ).values(
-            modified=datetime.datetime.now(),
+        item_row = connection.execute(self._update_item_modified_stmt, dict(
+            b_cid=collection_id,
+            b_name=href,
+            b_modified=datetime.datetime.now(),
+        )).one()
+        self._collection_updated(item_row.collection_id, connection=connection)
+
+    def _discover_walk_stmt(self, parts: int) -> sa.Select:
+        # the statement only depends on the number of path parts, the
+        # parts themselves are bound as p0, p1, ...
+        select_stmt = self._discover_walk_stmts.get(parts)
+        if select_stmt is not None:
+            return select_stmt
+        collection_table = self._collection_table
+
+        # walk down the collection tree one path part per level, starting
+        # at the root collection; only the collection table is touched
+        walk = sa.select(
+            collection_table.c.id,
+            sa.literal(0, sa.Integer()).label('depth'),
+        ).select_from(
+            collection_table,
+        ).where(
+            collection_table.c.parent_id == None,
+        ).cte(
+            'walk',
+            recursive=True,
+        )
+        walk = walk.union_all(sa.select(
+            collection_table.c.id,
+            (walk.c.depth + 1).label('depth'),
+        ).select_from(
+            collection_table.join(
+                walk,
+                collection_table.c.parent_id == walk.c.id,
+            ),
         ).where(
             sa.and_(
-                item_table.c.collection_id == collection_id,
-                item_table.c.name == href,
+                walk.c.depth < parts,
+                collection_table.c.name == sa.case(
+                    {i: sa.bindparam(f'p{i}', type_=sa.String()) for i in range(parts)},
+                    value=walk.c.depth,
+                ),
             ),
-        ).returning(item_table.c)).one()
-        self._collection_updated(item_row.collection_id, connection=connection)
+        ))
+        # the collection itself or, for items, its parent collection
+        select_stmt = sa.select(
+            walk.c.id,
+            walk.c.depth,
+        ).where(
+            walk.c.depth >= parts - 1,
+        ).order_by(
+            walk.c.depth.desc(),
+        )
+        self._discover_walk_stmts[parts] = select_stmt
+        return select_stmt
 
     def _discover(self, path: str, *, connection, depth: str = "0") -> Iterable["radicale.types.CollectionOrItem"]:
         if path == '/':
             return [create_collection(self, self._root_collection.id, '')]
         path_parts = self._split_path(path)
 
-        collection_table = self._meta.tables['collection']
-        item_table = self._meta.tables['item']
-
-        select_collection_or_item = sa.select(
-            collection_table.c.id,
-            collection_table.c.parent_id.label('parent_id'),
-            collection_table.c.modified,
-            collection_table.c.name,
-            sa.literal(None, sa.LargeBinary()).label('data'),
-            sa.literal('collection', sa.String(16)).label('type_'),
-        ).union_all(sa.select(
-            item_table.c.id,
-            item_table.c.collection_id.label('parent_id'),
-            item_table.c.modified,
-            item_table.c.name,
-            item_table.c.data,
-            sa.literal('item', sa.String(16)).label('type_'),
-        ).select_from(
-            item_table
-        ))
-
-        i = 0
-        select_from = select_collection_or_item.alias('data')
-        aliases = [select_from]
-        for path in path_parts[::-1]:
-            aliases += [select_collection_or_item.alias(f't{i}')]
-            i += 1
-            select_from = select_from.join(
-                aliases[-1],
-                sa.and_(
-                    aliases[-2].c.parent_id == aliases[-1].c.id,
-                    aliases[-2].c.name == path,
-                ),
-            )
-        select_stmt = sa.select(
-            aliases[0].c,
-        ).select_from(
-            select_from
-        ).where(
-            aliases[-1].c.parent_id == None,
-        )
+        select_stmt = self._discover_walk_stmt(len(path_parts))
 
         l = []
-        self_collection = connection.execute(select_stmt).one_or_none()
+        self_collection = connection.execute(
+            select_stmt, {f'p{i}': p for i, p in enumerate(path_parts)}).first()
         if self_collection is None:
             # None found
             return []
-        if self_collection.type_ != 'collection':
-            # Item found
+        if self_collection.depth != len(path_parts):
+            # Item might be found
+            item_row = connection.execute(
+                self._select_item_stmt, dict(cid=self_collection.id, name=path_parts[-1])).one_or_none()
+            if item_row is None:
+                return []
             return [Item(
-                collection=self._get_collection(self_collection.parent_id, connection=connection),
-                href=self_collection.name,
-                last_modified=self_collection.modified,
-                text=self_collection.data.decode(),
+                collection=create_collection(self, self_collection.id, '/'.join(path_parts[:-1])),
+                href=item_row.name,
+                last_modified=item_row.modified,
+                text=item_row.data.decode(),
             )]
 
         # collection found
@@ -571,27 +1027,14 @@ class Storage(BaseStorage):
         l += [self_collection]
         # collection should list contents
         if depth != "0":
-            sub_stmt_select_from = select_collection_or_item.alias()
-            select_sub_stmt = sa.select(
-                sub_stmt_select_from.c,
-            ).select_from(
-                sub_stmt_select_from,
-            ).where(
-                sa.and_(
-                    sub_stmt_select_from.c.parent_id == self_collection._id,
-                    sub_stmt_select_from.c.type_ == 'collection',
-                ),
-            )
-            for row in connection.execute(select_sub_stmt):
-                path = '/'.join(path_parts)
-                path += '/'
-                path += row.name
-                l += [create_collection(self, row.id, path)]
-            l += list(self_collection._get_all(connection=connection))
+            path = '/'.join(path_parts) + '/'
+            l.extend(create_collection(self, row.id, path + row.name) for row in connection.execute(
+                self._select_child_collections_stmt, dict(pid=self_collection._id)))
+            l.extend(self_collection._get_all(connection=connection))
         return l
 
     def discover(self, path: str, depth: str = "0") -> Iterable["radicale.types.CollectionOrItem"]:
-        with self._engine.begin() as c:
+        with self._begin() as c:
             return self._discover(path, connection=c, depth=depth)
 
     def _move(self, item: "radicale_item.Item", to_collection: "BaseCollection", to_href: str, *, connection) -> None:
@@ -599,37 +1042,119 @@ class Storage(BaseStorage):
         assert isinstance(to_collection, Collection)
         src_collection_id = item.collection._id
         dst_collection_id = to_collection._id
-        item_table = self._meta.tables['item']
-
-        delete_stmt = sa.delete(
-            item_table,
-        ).where(
-            sa.and_(
-                item_table.c.collection_id == dst_collection_id,
-                item_table.c.name == to_href,
+        item_table = self._item_table
+
+        if src_collection_id == dst_collection_id and item.href == to_href:
+            return
+        # a moved item counts as modified on every backend
+        modified = sa.bindparam('b_modified', datetime.datetime.now(), type_=sa.DateTime())
+        if self._engine.dialect.name == 'postgresql':
+            # delete the source and upsert it at the destination in one statement
+            src_stmt = sa.delete(
+                item_table,
+            ).where(
+                sa.and_(
+                    item_table.c.collection_id == src_collection_id,
+                    item_table.c.name == item.href,
+                ),
+            ).returning(
+                item_table.c.data,
+            ).cte('src')
+            # the id default is not applied to an INSERT from a CTE, pass it explicitly
+            insert_stmt = postgresql.insert(
+                item_table,
+            ).from_select(
+                ['id', 'collection_id', 'name', 'modified', 'data'],
+                sa.select(
+                    sa.literal(db._uuid7(), sa.Uuid()),
+                    sa.literal(dst_collection_id, sa.Uuid()),
+                    sa.literal(to_href, sa.String()),
+                    modified,
+                    src_stmt.c.data,
+                ),
             )
-        )
-        update_stmt = sa.update(
-            item_table,
-        ).values(
-            collection_id=dst_collection_id,
-            name=to_href,
-        ).where(
-            sa.and_(
-                item_table.c.collection_id == src_collection_id,
-                item_table.c.name == item.href,
+            move_stmts = [
+                insert_stmt.on_conflict_do_update(
+                    index_elements=[item_table.c.collection_id, item_table.c.name],
+                    set_=dict(
+                        modified=insert_stmt.excluded.modified,
+                        data=insert_stmt.excluded.data,
+                    ),
+                ),
+            ]
+        elif self._dialect_insert is not None:
+            # copy the item over the destination in one statement, then drop the source
+            insert_stmt = self._dialect_insert(
+                item_table,
+            ).from_select(
+                ['collection_id', 'name', 'modified', 'data'],
+                sa.select(
+                    sa.literal(dst_collection_id, sa.Uuid()),
+                    sa.literal(to_href, sa.String()),
+                    modified,
+                    item_table.c.data,
+                ).where(
+                    sa.and_(
+                        item_table.c.collection_id == src_collection_id,
+                        item_table.c.name == item.href,
+                    ),
+                ),
             )
-        )
-        connection.execute(delete_stmt)
-        connection.execute(update_stmt)
-        self._collection_updated(src_collection_id, connection=connection)
-        self._collection_updated(dst_collection_id, connection=connection)
+            move_stmts = [
+                insert_stmt.on_conflict_do_update(
+                    index_elements=[item_table.c.collection_id, item_table.c.name],
+                    set_=dict(
+                        modified=insert_stmt.excluded.modified,
+                        data=insert_stmt.excluded.data,
+                    ),
+                ),
+                sa.delete(
+                    item_table,
+                ).where(
+                    sa.and_(
+                        item_table.c.collection_id == src_collection_id,
+                        item_table.c.name == item.href,
+                    ),
+                ),
+            ]
+        else:
+            move_stmts = [
+                sa.delete(
+                    item_table,
+                ).where(
+                    sa.and_(
+                        item_table.c.collection_id == dst_collection_id,
+                        item_table.c.name == to_href,
+                    )
+                ),
+                sa.update(
+                    item_table,
+                ).values(
+                    collection_id=dst_collection_id,
+                    name=to_href,
+                    modified=modified,
+                ).where(
+                    sa.and_(
+                        item_table.c.collection_id == src_collection_id,
+                        item_table.c.name == item.href,
+                    )
+                ),
+            ]
+        # the destination is reindexed below
+        connection.execute(self._delete_item_index_stmt, [
+            dict(b_cid=src_collection_id, b_name=item.href),
+            dict(b_cid=dst_collection_id, b_name=to_href),
+        ])
+        for stmt in move_stmts:
+            connection.execute(stmt)
+        self._collection_updated(src_collection_id, dst_collection_id, connection=connection)
         to_collection._update_history_etag(to_href, item, connection=connection)
+        to_collection._index_items({to_href: item}, connection=connection)
         assert item.href is not None
         item.collection._update_history_etag(item.href, None, connection=connection)
 
     def move(self, item: "radicale_item.Item", to_collection: "BaseCollection", to_href: str) -> None:
-        with self._engine.begin() as c:
+        with self._begin(atomic=True) as c:
             return self._move(item, to_collection, to_href, connection=c)
 
     def _create_collection(
@@ -643,13 +1168,13 @@ class Storage(BaseStorage):
         logger.debug('create_collection: %s, %s, %s', href, items, props)
         path = self._split_path(href)
         parent_id = self._root_collection.id
-        collection_table = self._meta.tables['collection']
-        collection_metadata_table = self._meta.tables['collection_metadata']
-        item_table = self._meta.tables['item']
+        collection_table = self._collection_table
+        collection_metadata_table = self._collection_metadata_table
+        item_table = self._item_table
 
         for p in path:
             select_stmt = sa.select(
-                collection_table.c,
+                collection_table.c.id,
             ).select_from(
                 collection_table,
             ).where(
@@ -666,7 +1191,7 @@ class Storage(BaseStorage):
                     parent_id=parent_id,
                     name=p,
                 ).returning(
-                    collection_table.c,
+                    collection_table.c.id,
                 )
                 c = connection.execute(insert_stmt).one()
             parent_id = c.id
@@ -689,12 +1214,14 @@ class Storage(BaseStorage):
             )
             connection.execute(delete_collections_stmt)
             connection.execute(delete_meta_stmt)
+            connection.execute(self._delete_collection_item_index_stmt, dict(cid=parent_id))
             connection.execute(delete_items_stmt)
-        if props is not None:
-            insert_stmt = sa.insert(
-                collection_metadata_table,
-            ).values([dict(collection_id=parent_id, key=k, value=v) for k, v in props.items()])
-            connection.execute(insert_stmt)
+            self._forget_collections(parent_id)
+        if props:
+            connection.execute(
+                sa.insert(collection_metadata_table),
+                [dict(collection_id=parent_id, key=k, value=v) for k, v in props.items()],
+            )
         c = Collection(self, parent_id, '/'.join(path))
         if props is not None and 'tag' in props and items is not None:
             suffix = '.bin'
@@ -702,8 +1229,9 @@ class Storage(BaseStorage):
                 suffix = '.vcf'
             elif props['tag'] == 'VCALENDAR':
                 suffix = '.ics'
-            for i in items:
-                c._upload(i.uid + suffix, i, connection=connection)
+            # the collection has just been emptied, so the items can be inserted in bulk;
+            # items sharing an uid share an href, the last one wins like with upload()
+            c._upload_many({i.uid + suffix: i for i in items}, connection=connection)
         return c
 
     def create_collection(
@@ -712,18 +1240,61 @@ class Storage(BaseStorage):
             items: Optional[Iterable["radicale_item.Item"]] = None,
             props: Optional[Mapping[str, str]] = None,
     ) -> "BaseCollection":
-        with self._engine.begin() as c:
+        with self._begin(atomic=True) as c:
             return self._create_collection(href, connection=c, items=items, props=props)
 
+    def _insert_ignore(self, table: sa.Table) -> sa.Insert:
+        # an INSERT that skips rows whose key exists already
+        if self._dialect_insert is not None:
+            return self._dialect_insert(table).on_conflict_do_nothing()
+        if self._engine.dialect.name in ('mysql', 'mariadb'):
+            return mysql.insert(table).prefix_with('IGNORE')
+        return sa.insert(table)
+
+    @contextlib.contextmanager
+    def _begin(self, *, atomic: bool = False) -> Iterator[sa.engine.Connection]:
+        # reuse the transaction of the current request, if there is one, or
+        # the one this thread has open already, like a get_all() being iterated
+        connection = self._request_connection.get()
+        if connection is None:
+            connection = getattr(self._thread_connection, 'connection', None)
+        if connection is not None:
+            if atomic:
+                # a failed write is rolled back on its own, radicale may
+                # answer it with an error and still commit the request
+                with connection.begin_nested():
+                    yield connection
+            else:
+                yield connection
+            return
+        engine = self._write_engine if atomic else self._engine
+        with self._transaction_lock, engine.begin() as connection:
+            self._thread_connection.connection = connection
+            try:
+                yield connection
+            finally:
+                self._thread_connection.connection = None
+
     @radicale.types.contextmanager
     def acquire_lock(self, mod: str, user: str = "") -> Iterator[None]:
-        _ = mod, user
-        yield
+        _ = user
+        # the whole request shares one connection and transaction
+        engine = self._write_engine if mod == 'w' else self._engine
+        with self._transaction_lock, engine.begin() as connection:
+            token = self._request_connection.set(connection)
+            meta_token = self._request_meta.set({})
+            last_modified_token = self._request_last_modified.set({})
+            try:
+                yield
+            finally:
+                self._request_last_modified.reset(last_modified_token)
+                self._request_meta.reset(meta_token)
+                self._request_connection.reset(token)
 
     def _verify(self, *, connection) -> bool:
         _ = connection
         return True
 
     def verify(self):
-        with self._engine.begin() as c:
+        with self._begin() as c:
             return self._verify(connection=c)
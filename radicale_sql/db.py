@@ -1,10 +1,54 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import time
 import uuid
 import datetime
+import warnings
+import zlib
 from typing import Tuple
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+# stored payloads never start with this, items always start with "BEGIN:"
+COMPRESSED_PREFIX = b'~zlib:'
+
+
+class CompressedBinary(sa.types.TypeDecorator):
+    # payloads above min_size are stored zlib compressed behind
+    # COMPRESSED_PREFIX, anything else, including data written before, as is;
+    # only large ones, like contacts with photos, are worth the decompression
+    # on every read
+    impl = sa.LargeBinary
+    cache_ok = True
+    min_size = 16384
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name in ('mysql', 'mariadb'):
+            # a plain BLOB is capped at 64 KiB
+            return dialect.type_descriptor(mysql.LONGBLOB())
+        return dialect.type_descriptor(sa.LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and len(value) >= self.min_size:
+            compressed = COMPRESSED_PREFIX + zlib.compress(value)
+            if len(compressed) < len(value):
+                return compressed
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.startswith(COMPRESSED_PREFIX):
+            return zlib.decompress(value[len(COMPRESSED_PREFIX):])
+        return value
+
+
+def _uuid7() -> uuid.UUID:
+    # time ordered (RFC 9562 version 7), new rows land at the end of the primary key indexes
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xf << 76) | 0x7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return uuid.UUID(int=value)
 
 
 def create_meta() -> sa.MetaData:
@@ -16,7 +60,7 @@ def create_meta() -> sa.MetaData:
         sa.Column(
             'id',
             sa.Uuid(),
-            default=uuid.uuid4,
+            default=_uuid7,
             primary_key=True,
         ),
         sa.Column(
@@ -36,7 +80,6 @@ def create_meta() -> sa.MetaData:
         sa.Column(
             'name',
             sa.String(128),
-            index=True,
             nullable=True,
         ),
         sa.UniqueConstraint('parent_id', 'name'),
@@ -64,35 +107,61 @@ def create_meta() -> sa.MetaData:
     )
 
     sa.Table(
-        'collection_state',
+        'collection_state_token',
         meta,
         sa.Column(
             'collection_id',
             sa.Uuid(),
             sa.ForeignKey('collection.id', ondelete='CASCADE'),
-            index=True,
-            nullable=False,
+            primary_key=True,
         ),
         sa.Column(
             'name',
             sa.String(length=128),  # could be only 64 long
-            index=True,
-            nullable=False,
+            primary_key=True,
         ),
         sa.Column(
-            'state',
-            sa.LargeBinary(),
+            'modified',
+            sa.DateTime(),
+            default=datetime.datetime.now,
+            onupdate=datetime.datetime.now,
             nullable=False,
         ),
     )
 
     sa.Table(
+        'collection_state_entry',
+        meta,
+        sa.Column(
+            'collection_id',
+            sa.Uuid(),
+            sa.ForeignKey('collection.id', ondelete='CASCADE'),
+            primary_key=True,
+        ),
+        sa.Column(
+            'name',
+            sa.String(length=128),  # could be only 64 long
+            primary_key=True,
+        ),
+        sa.Column(
+            'href',
+            sa.String(128),
+            primary_key=True,
+        ),
+        sa.Column(
+            'history_etag',
+            sa.String(64),  # sha256 hex digest
+            nullable=False,
+        ),
+    )
+
+    item = sa.Table(
         'item',
         meta,
         sa.Column(
             'id',
             sa.Uuid(),
-            default=uuid.uuid4,
+            default=_uuid7,
             primary_key=True,
         ),
         sa.Column(
@@ -112,15 +181,53 @@ def create_meta() -> sa.MetaData:
         sa.Column(
             'name',
             sa.String(128),
-            index=True,
             nullable=True,
         ),
         sa.Column(
             'data',
-            sa.LargeBinary(),
+            CompressedBinary(),
         ),
         sa.UniqueConstraint('collection_id', 'name'),
     )
+    # large payloads are compressed already, skip pglz when they are toasted
+    sa.event.listen(
+        item,
+        'after_create',
+        sa.DDL('ALTER TABLE item ALTER COLUMN data SET STORAGE EXTERNAL').execute_if(dialect='postgresql'),
+    )
+
+    sa.Table(
+        'item_index',
+        meta,
+        sa.Column(
+            'item_id',
+            sa.Uuid(),
+            sa.ForeignKey('item.id', ondelete='CASCADE'),
+            primary_key=True,
+        ),
+        sa.Column(
+            'component',
+            sa.String(16),
+            nullable=True,
+        ),
+        sa.Column(
+            'time_start',
+            sa.BigInteger(),
+            nullable=False,
+        ),
+        sa.Column(
+            'time_end',
+            sa.BigInteger(),
+            nullable=False,
+        ),
+        sa.Column(
+            'uid',
+            sa.String(1024),
+            nullable=True,
+        ),
+        # InnoDB keys are limited to 3072 bytes, index a prefix of the uid there
+        sa.Index('ix_item_index_uid', 'uid', mysql_length=255),
+    )
 
     sa.Table(
         'item_history',
@@ -128,7 +235,7 @@ def create_meta() -> sa.MetaData:
         sa.Column(
             'id',
             sa.Uuid(),
-            default=uuid.uuid4,
+            default=_uuid7,
             primary_key=True,
         ),
         sa.Column(
@@ -148,29 +255,156 @@ def create_meta() -> sa.MetaData:
         sa.Column(
             'name',
             sa.String(128),
-            index=True,
             nullable=True,
         ),
         sa.Column(
             'etag',
-            sa.String(1024),
+            sa.String(66),  # quoted sha256 hex digest
             nullable=False,
         ),
         sa.Column(
             'history_etag',
-            sa.String(1024),
+            sa.String(64),  # sha256 hex digest
             nullable=True,
-        )
+        ),
+        # an index instead of a constraint, so it can be added to existing databases
+        sa.Index('ix_item_history_collection_id_name', 'collection_id', 'name', unique=True),
+        # stale history entries are deleted by collection and age
+        sa.Index('ix_item_history_collection_id_modified', 'collection_id', 'modified'),
     )
 
     return meta
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    # WAL lets readers proceed while a request writes
+    _ = connection_record
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.execute('PRAGMA cache_size=-16000')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
+    # pysqlite starts transactions on its own, which breaks SAVEPOINTs;
+    # _begin_sqlite_transaction() starts them instead
+    dbapi_connection.isolation_level = None
+
+
+def _begin_sqlite_transaction(connection) -> None:
+    # a deferred transaction can fail to upgrade its read lock to a write lock
+    # without waiting for the busy timeout, so writers take it up front
+    if connection.get_execution_options().get('immediate'):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    else:
+        connection.exec_driver_sql('BEGIN')
+
+
+def _delete_duplicates(connection, table: sa.Table, columns) -> None:
+    # rows written before a unique index existed may collide, keep the newest
+    newer = table.alias('newer')
+    newer_exists = sa.and_(
+        *(newer.c[column.name] == column for column in columns),
+        sa.or_(
+            newer.c.modified > table.c.modified,
+            sa.and_(newer.c.modified == table.c.modified, newer.c.id > table.c.id),
+        ),
+    )
+    if connection.dialect.name in ('mysql', 'mariadb'):
+        # MySQL cannot select from the table a DELETE subquery deletes from
+        delete_stmt = sa.delete(table).where(newer_exists)
+    else:
+        delete_stmt = sa.delete(table).where(sa.exists().where(newer_exists))
+    connection.execute(delete_stmt)
+
+
+def _merge_collections(connection, collection: sa.Table, source_id, target_id) -> None:
+    # children move to the target, or are merged into its child of the same name
+    target_children = dict(connection.execute(
+        sa.select(collection.c.name, collection.c.id).where(collection.c.parent_id == target_id)
+    ).all())
+    source_children = connection.execute(
+        sa.select(collection.c.name, collection.c.id).where(collection.c.parent_id == source_id)
+    ).all()
+    for name, child_id in source_children:
+        if name in target_children:
+            _merge_collections(connection, collection, child_id, target_children[name])
+        else:
+            connection.execute(sa.update(collection).where(collection.c.id == child_id).values(parent_id=target_id))
+    connection.execute(sa.delete(collection).where(collection.c.id == source_id))
+
+
+def _delete_duplicate_roots(connection, collection: sa.Table) -> None:
+    # processes starting at the same time could each create a root before
+    # the root index existed, keep the newest like _delete_duplicates()
+    root_ids = connection.execute(
+        sa.select(
+            collection.c.id,
+        ).where(
+            collection.c.parent_id == None,
+        ).order_by(
+            collection.c.modified.desc(),
+            collection.c.id.desc(),
+        )
+    ).scalars().all()
+    for root_id in root_ids[1:]:
+        _merge_collections(connection, collection, root_id, root_ids[0])
+
+
 def create(url: str, meta: sa.MetaData) -> Tuple[sa.engine.Engine, sa.engine.Row]:
-    engine = sa.create_engine(url)
-    meta.create_all(engine)
+    engine_options = dict(query_cache_size=1200)
+    url_ = sa.engine.make_url(url)
+    if url_.get_backend_name() == 'sqlite':
+        if url_.database in (None, '', ':memory:'):
+            # a single connection shared by all threads, or each thread
+            # would see its own empty database
+            engine_options.update(poolclass=sa.pool.StaticPool, connect_args=dict(check_same_thread=False))
+    else:
+        # every request holds one connection for its whole duration;
+        # recycling replaces connections dropped by the server instead
+        # of pinging on every checkout
+        engine_options.update(pool_size=16, max_overflow=32, pool_recycle=1800)
+    if url_.get_driver_name() == 'psycopg2':
+        # pipeline executemany() batches into multi-row INSERTs
+        engine_options['executemany_mode'] = 'values_plus_batch'
+    engine = sa.create_engine(url, **engine_options)
+    if engine.dialect.name == 'sqlite':
+        sa.event.listen(engine, 'connect', _set_sqlite_pragmas)
+        sa.event.listen(engine, 'begin', _begin_sqlite_transaction)
+    # reflect the schema once instead of checking every table and index on its own
+    with engine.begin() as connection, warnings.catch_warnings():
+        # the root collection index below is not reflected, it is not needed either
+        warnings.filterwarnings('ignore', 'Skipped unsupported reflection of expression-based index', sa.exc.SAWarning)
+        inspector = sa.inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        if not existing_tables.issuperset(meta.tables):
+            meta.create_all(connection)
+        # create_all() skips existing tables, add indexes introduced later on
+        for table in meta.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    if index.unique:
+                        _delete_duplicates(connection, table, index.columns)
+                    index.create(connection)
 
     collection = meta.tables['collection']
+    if engine.dialect.name in ('postgresql', 'sqlite'):
+        # there is only one root; NULLs never conflict in unique indexes, so
+        # it is on an expression, which checkfirst cannot reflect
+        root_index = sa.Index(
+            'uq_collection_root',
+            collection.c.parent_id.is_(None),
+            unique=True,
+            sqlite_where=collection.c.parent_id.is_(None),
+            postgresql_where=collection.c.parent_id.is_(None),
+        )
+        with engine.begin() as connection:
+            _delete_duplicate_roots(connection, collection)
+            connection.execute(sa.schema.CreateIndex(root_index, if_not_exists=True))
     with engine.begin() as connection:
         select_root_collection = sa.select(
             collection.c
@@ -180,7 +414,20 @@ def create(url: str, meta: sa.MetaData) -> Tuple[sa.engine.Engine, sa.engine.Row
             collection.c.parent_id == None,
         )
         root_collection = connection.execute(select_root_collection).one_or_none()
-        if root_collection is None:
+        if root_collection is None and engine.dialect.name in ('postgresql', 'sqlite'):
+            # another process may be creating the root at the same time
+            dialect_insert = postgresql.insert if engine.dialect.name == 'postgresql' else sqlite.insert
+            insert_root_collection = dialect_insert(
+                collection,
+            ).values(parent_id=None).on_conflict_do_nothing(
+                # expressions in the conflict target need their own parentheses on PostgreSQL
+                index_elements=[sa.text('(parent_id IS NULL)')],
+                index_where=collection.c.parent_id.is_(None),
+            ).returning(collection.c)
+            root_collection = connection.execute(insert_root_collection).one_or_none()
+            if root_collection is None:
+                root_collection = connection.execute(select_root_collection).one()
+        elif root_collection is None:
             insert_root_collection = sa.insert(
                 collection,
             ).values(parent_id=None).returning(collection.c)
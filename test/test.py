@@ -1,11 +1,16 @@
 import os
+import contextlib
+import socket
 import unittest
 import subprocess
 import time
+import functools
+import concurrent.futures
+import sqlite3
+import xml.etree.ElementTree as ET
 import requests
 import vobject
 from requests.auth import HTTPBasicAuth
-from passlib.apache import HtpasswdFile
 import logging
 
 # Setup logging
@@ -16,7 +21,10 @@ logger = logging.getLogger(__name__)
 config_path = os.path.abspath('./radicale_config')
 database_path = os.path.abspath('./test-data.db')
 htpasswd_path = os.path.abspath('./.htpasswd')
+upgrade_config_path = os.path.abspath('./radicale_upgrade_config')
+upgrade_database_path = os.path.abspath('./test-upgrade.db')
 radicale_port = 5232
+upgrade_port = 5233
 radicale_host = '127.0.0.1'
 radicale_url = f'http://{radicale_host}:{radicale_port}/'
 
@@ -32,6 +40,18 @@ CREATE_CALENDAR_XML = '''<?xml version="1.0" encoding="UTF-8" ?>
   </set>
 </create>'''
 
+CREATE_ADDRESSBOOK_XML = '''<?xml version="1.0" encoding="UTF-8" ?>
+<create xmlns="DAV:" xmlns:CR="urn:ietf:params:xml:ns:carddav">
+  <set>
+    <prop>
+      <resourcetype>
+        <collection />
+        <CR:addressbook />
+      </resourcetype>
+    </prop>
+  </set>
+</create>'''
+
 ics_contents = {
     'user1': """BEGIN:VCALENDAR
 VERSION:2.0
@@ -68,58 +88,176 @@ END:VEVENT
 END:VCALENDAR"""
 }
 
+# payloads of the bigger tests, built and encoded once
+large_ics_content = f"""BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:uid-single-event@example.com
+DTSTAMP:20200714T170000Z
+ORGANIZER;CN=User One:MAILTO:user1@example.com
+DTSTART:20200714T170000Z
+DTEND:20200714T180000Z
+SUMMARY:Large Single Event
+DESCRIPTION:{"A" * 100000}
+END:VEVENT
+END:VCALENDAR""".encode()
 
-class TestRadicaleServer(unittest.TestCase):
-    @classmethod
-    def setUpClass(cls):
-        try:
-            if os.path.exists(database_path):
-                os.remove(database_path)
-            if os.path.exists(htpasswd_path):
-                os.remove(htpasswd_path)
-            if os.path.exists(config_path):
-                os.remove(config_path)
-
-            # Create .htpasswd file with user credentials
-            ht = HtpasswdFile(htpasswd_path, new=True)
-            ht.set_password('user1', 'password')
-            ht.set_password('user2', 'password')
-            ht.set_password('user3', 'password')
-            ht.save()
-
-            # Update Radicale config to use .htpasswd file
-            with open(config_path, 'w') as config_file:
-                config_file.write(f"""
+concurrent_ics_contents = [f"""BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:uid{i}@example.com
+DTSTAMP:20200714T170000Z
+ORGANIZER;CN=User One:MAILTO:user1@example.com
+DTSTART:20200714T170000Z
+DTEND:20200714T180000Z
+SUMMARY:Event {i}
+END:VEVENT
+END:VCALENDAR""".encode() for i in range(5)]
+
+
+TIME_RANGE_REPORT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<C:calendar-query xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop xmlns:D="DAV:">
+    <D:getetag/>
+  </D:prop>
+  <C:filter>
+    <C:comp-filter name="VCALENDAR">
+      <C:comp-filter name="VEVENT">
+        <C:time-range start="{start}" end="{end}"/>
+      </C:comp-filter>
+    </C:comp-filter>
+  </C:filter>
+</C:calendar-query>'''
+
+SYNC_COLLECTION_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<D:sync-collection xmlns:D="DAV:">
+  <D:sync-token>{token}</D:sync-token>
+  <D:sync-level>1</D:sync-level>
+  <D:prop>
+    <D:getetag/>
+  </D:prop>
+</D:sync-collection>'''
+
+# the schema the first release created, with a calendar and the history of a deleted item
+BASELINE_SCHEMA_SQL = """
+CREATE TABLE collection (
+    id CHAR(32) NOT NULL, parent_id CHAR(32), modified DATETIME NOT NULL, name VARCHAR(128),
+    PRIMARY KEY (id), UNIQUE (parent_id, name), FOREIGN KEY(parent_id) REFERENCES collection (id));
+CREATE INDEX ix_collection_parent_id ON collection (parent_id);
+CREATE INDEX ix_collection_name ON collection (name);
+CREATE TABLE collection_metadata (
+    collection_id CHAR(32) NOT NULL, "key" VARCHAR(128) NOT NULL, value TEXT,
+    PRIMARY KEY (collection_id, "key"), UNIQUE (collection_id, "key"),
+    FOREIGN KEY(collection_id) REFERENCES collection (id) ON DELETE CASCADE);
+CREATE TABLE collection_state (
+    collection_id CHAR(32) NOT NULL, name VARCHAR(128) NOT NULL, state BLOB NOT NULL,
+    FOREIGN KEY(collection_id) REFERENCES collection (id) ON DELETE CASCADE);
+CREATE INDEX ix_collection_state_collection_id ON collection_state (collection_id);
+CREATE INDEX ix_collection_state_name ON collection_state (name);
+CREATE TABLE item (
+    id CHAR(32) NOT NULL, collection_id CHAR(32) NOT NULL, modified DATETIME NOT NULL, name VARCHAR(128), data BLOB,
+    PRIMARY KEY (id), UNIQUE (collection_id, name),
+    FOREIGN KEY(collection_id) REFERENCES collection (id) ON DELETE CASCADE);
+CREATE INDEX ix_item_name ON item (name);
+CREATE INDEX ix_item_collection_id ON item (collection_id);
+CREATE TABLE item_history (
+    id CHAR(32) NOT NULL, collection_id CHAR(32) NOT NULL, modified DATETIME NOT NULL, name VARCHAR(128),
+    etag VARCHAR(1024) NOT NULL, history_etag VARCHAR(1024),
+    PRIMARY KEY (id), FOREIGN KEY(collection_id) REFERENCES collection (id) ON DELETE CASCADE);
+CREATE INDEX ix_item_history_name ON item_history (name);
+CREATE INDEX ix_item_history_collection_id ON item_history (collection_id);
+INSERT INTO collection VALUES ('00000000000000000000000000000001', NULL, '2024-01-01 00:00:00.000000', NULL);
+INSERT INTO collection VALUES ('00000000000000000000000000000002', '00000000000000000000000000000001',
+    '2024-01-01 00:00:00.000000', 'user1');
+INSERT INTO collection VALUES ('00000000000000000000000000000003', '00000000000000000000000000000002',
+    '2024-01-01 00:00:00.000000', 'calendar');
+INSERT INTO collection_metadata VALUES ('00000000000000000000000000000003', 'tag', 'VCALENDAR');
+-- the history of a deleted item, written twice by concurrent requests
+INSERT INTO item_history VALUES ('00000000000000000000000000000004', '00000000000000000000000000000003',
+    '2024-01-01 00:00:00.000000', 'deleted.ics', '', 'aaaa');
+INSERT INTO item_history VALUES ('00000000000000000000000000000005', '00000000000000000000000000000003',
+    '2024-01-02 00:00:00.000000', 'deleted.ics', '', 'bbbb');
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def canonical_ics(content: bytes) -> str:
+    # parse and serialize once per distinct payload, fixtures repeat across tests
+    return vobject.readOne(content.decode()).serialize()
+
+
+def remove_files(*paths):
+    # SQLite's WAL files are left behind when a server is killed
+    for path in paths:
+        for file_path in (path, f'{path}-wal', f'{path}-shm'):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+
+def write_server_config(path, port, database):
+    # Create .htpasswd file with user credentials, in plain text so
+    # the server does not hash the password on every request
+    with open(htpasswd_path, 'w') as htpasswd_file:
+        htpasswd_file.writelines(f'{user}:password\n' for user in ('user1', 'user2', 'user3'))
+
+    # Update Radicale config to use .htpasswd file
+    with open(path, 'w') as config_file:
+        config_file.write(f"""
 [auth]
 type = htpasswd
 htpasswd_filename = {htpasswd_path}
-htpasswd_encryption = md5
+htpasswd_encryption = plain
 [server]
-hosts = {radicale_host}:{radicale_port}
+hosts = {radicale_host}:{port}
 [storage]
 type=radicale_sql
-url=sqlite:///{database_path}
+url=sqlite:///{database}
 """)
 
-            cls.process = subprocess.Popen(
-                ['radicale', '--config', config_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-
-            # Wait for the server to start
-            for _ in range(10):
-                if cls.process.poll() is not None:
-                    raise Exception("Radicale server terminated prematurely")
-                try:
-                    response = requests.get(radicale_url)
-                    if response.status_code == 200:
-                        logger.info("Radicale server started successfully")
-                        break
-                except requests.ConnectionError:
-                    time.sleep(0.5)
-            else:
-                raise Exception("Radicale server did not start within the expected time")
+
+def start_server(path, port, session):
+    # the output is not read, a full pipe would block the server
+    process = subprocess.Popen(
+        ['radicale', '--config', path],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+    # Wait for the server to listen, then check it answers
+    deadline = time.monotonic() + 5.0
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception("Radicale server terminated prematurely")
+        try:
+            socket.create_connection((radicale_host, port), timeout=0.05).close()
+            break
+        except OSError:
+            time.sleep(0.01)
+    else:
+        process.terminate()
+        raise Exception("Radicale server did not start within the expected time")
+    response = session.get(f'http://{radicale_host}:{port}/')
+    if response.status_code != 200:
+        process.terminate()
+        raise Exception(f"Radicale server answered with {response.status_code}")
+    logger.info("Radicale server started successfully")
+    return process
+
+
+class TestRadicaleServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        try:
+            remove_files(database_path, htpasswd_path, config_path)
+            write_server_config(config_path, radicale_port, database_path)
+
+            # one session keeps connections to the server alive between requests
+            cls.session = requests.Session()
+            cls.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+            # shared by the tests that run requests concurrently
+            cls.pool = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+            cls.process = start_server(config_path, radicale_port, cls.session)
 
         except Exception as e:
             cls.tearDownClass()
@@ -130,34 +268,30 @@ url=sqlite:///{database_path}
         if hasattr(cls, 'process'):
             cls.process.terminate()
             cls.process.wait()
-        if os.path.exists(database_path):
-            os.remove(database_path)
-        if os.path.exists(htpasswd_path):
-            os.remove(htpasswd_path)
-        if os.path.exists(config_path):
-            os.remove(config_path)
+        if hasattr(cls, 'pool'):
+            cls.pool.shutdown(wait=True)
+        if hasattr(cls, 'session'):
+            cls.session.close()
+        remove_files(database_path, htpasswd_path, config_path)
 
     def test_radicale_is_running(self):
-        response = requests.get(radicale_url)
+        response = self.session.get(radicale_url)
         self.assertEqual(response.status_code, 200)
 
     def create_collection(self, username, password, collection):
         url = f'{radicale_url}{username}/{collection}/'
-        response = requests.request('MKCOL', url, data=CREATE_CALENDAR_XML, auth=HTTPBasicAuth(username, password))
+        response = self.session.request('MKCOL', url, data=CREATE_CALENDAR_XML, auth=HTTPBasicAuth(username, password))
         self.assertIn(response.status_code, [201, 204])
 
-        response = requests.request('PROPFIND', url, auth=HTTPBasicAuth(username, password))
+        response = self.session.request('PROPFIND', url, auth=HTTPBasicAuth(username, password))
         self.assertEqual(response.status_code, 207)
 
     def add_ics_file(self, username, password, collection, filename, content, return_code=[201, 204]):
         url = f'{radicale_url}{username}/{collection}/{filename}'
         headers = {'Content-Type': 'text/calendar'}
-        response = requests.put(url, data=content, headers=headers, auth=(username, password))
+        response = self.session.put(url, data=content, headers=headers, auth=(username, password))
         self.assertIn(response.status_code, return_code)
 
-    def parse_ics(self, content):
-        return vobject.readOne(content)
-
     def test_user_access(self):
         users = ['user1', 'user2', 'user3']
         password = 'password'
@@ -171,17 +305,14 @@ url=sqlite:///{database_path}
         # Verify that each user can only access their own collection and data
         for user, ics_content in ics_contents.items():
             with self.subTest(user=user):
-                response = requests.get(f'{radicale_url}{user}/calendar/event.ics', auth=(user, password))
+                response = self.session.get(f'{radicale_url}{user}/calendar/event.ics', auth=(user, password))
                 self.assertEqual(response.status_code, 200)
 
-                parsed_response = self.parse_ics(response.text)
-                parsed_ics_content = self.parse_ics(ics_content)
-
-                self.assertEqual(parsed_response.serialize(), parsed_ics_content.serialize())
+                self.assertEqual(canonical_ics(response.content), canonical_ics(ics_content.encode()))
 
                 for other_user in users:
                     if other_user != user:
-                        response = requests.get(f'{radicale_url}{other_user}/calendar/event.ics', auth=(user, password))
+                        response = self.session.get(f'{radicale_url}{other_user}/calendar/event.ics', auth=(user, password))
                         self.assertEqual(response.status_code, 403)
 
         for user, ics_content in ics_contents.items():
@@ -189,12 +320,12 @@ url=sqlite:///{database_path}
                 self.delete_collection(user, password, 'calendar')
 
     def test_invalid_authentication(self):
-        response = requests.get(f'{radicale_url}user1/calendar/', auth=('user1', 'wrongpassword'))
+        response = self.session.get(f'{radicale_url}user1/calendar/', auth=('user1', 'wrongpassword'))
         self.assertEqual(response.status_code, 401)
 
     def delete_collection(self, username, password, collection):
         url = f'{radicale_url}{username}/{collection}/'
-        response = requests.request('DELETE', url, auth=HTTPBasicAuth(username, password))
+        response = self.session.request('DELETE', url, auth=HTTPBasicAuth(username, password))
         self.assertIn(response.status_code, [200, 204, 404])
 
     def test_delete_collection(self):
@@ -203,13 +334,13 @@ url=sqlite:///{database_path}
         collection = 'calendar'
         self.create_collection(username, password, collection)
         self.delete_collection(username, password, collection)
-        response = requests.get(f'{radicale_url}{username}/{collection}/', auth=(username, password))
+        response = self.session.get(f'{radicale_url}{username}/{collection}/', auth=(username, password))
         self.assertEqual(response.status_code, 404)
 
     def update_ics_file(self, username, password, collection, filename, new_content):
         url = f'{radicale_url}{username}/{collection}/{filename}'
         headers = {'Content-Type': 'text/calendar'}
-        response = requests.put(url, data=new_content, headers=headers, auth=(username, password))
+        response = self.session.put(url, data=new_content, headers=headers, auth=(username, password))
         self.assertIn(response.status_code, [201, 204])
 
     def test_update_ics_file(self):
@@ -231,14 +362,14 @@ END:VCALENDAR"""
         self.create_collection(username, password, collection)
         self.add_ics_file(username, password, collection, filename, ics_contents['user1'])
         self.update_ics_file(username, password, collection, filename, new_content)
-        response = requests.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
+        response = self.session.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
         self.assertEqual(response.status_code, 200)
         self.assertIn("Updated User One Event", response.text)
         self.delete_collection(username, password, collection)
 
     def test_fetch_nonexistent_ics_file(self):
         self.create_collection('user1', 'password', 'calendar')
-        response = requests.get(f'{radicale_url}user1/calendar/nonexistent.ics', auth=('user1', 'password'))
+        response = self.session.get(f'{radicale_url}user1/calendar/nonexistent.ics', auth=('user1', 'password'))
         self.assertEqual(response.status_code, 404)
         self.delete_collection('user1', 'password', 'calendar')
 
@@ -246,7 +377,7 @@ END:VCALENDAR"""
         # Assuming 'user1' tries to access 'user2's collection
         self.create_collection('user1', 'password', 'calendar')
         self.create_collection('user2', 'password', 'calendar')
-        response = requests.get(f'{radicale_url}user2/calendar/', auth=('user1', 'password'))
+        response = self.session.get(f'{radicale_url}user2/calendar/', auth=('user1', 'password'))
         self.assertEqual(response.status_code, 403)
         self.delete_collection('user1', 'password', 'calendar')
         self.delete_collection('user2', 'password', 'calendar')
@@ -256,71 +387,35 @@ END:VCALENDAR"""
         password = 'password'
         collection = 'large_calendar'
         filename = 'large_event.ics'
-        # Generate a large ICS file content with a single event but a large description
-        large_description = "A" * 100000  # 10,000 characters for example
-        large_ics_content = f"""BEGIN:VCALENDAR
-VERSION:2.0
-BEGIN:VEVENT
-UID:uid-single-event@example.com
-DTSTAMP:20200714T170000Z
-ORGANIZER;CN=User One:MAILTO:{username}@example.com
-DTSTART:20200714T170000Z
-DTEND:20200714T180000Z
-SUMMARY:Large Single Event
-DESCRIPTION:{large_description}
-END:VEVENT
-END:VCALENDAR"""
         # Create a new calendar collection
         self.create_collection(username, password, collection)
         # Add the large ICS file to the collection
         self.add_ics_file(username, password, collection, filename, large_ics_content)
         # Fetch the added ICS file
-        response = requests.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
+        response = self.session.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
         self.assertEqual(response.status_code, 200)
         # Assert the fetched content matches the original large ICS file content
-        parsed_response = self.parse_ics(response.text)
-        parsed_ics_content = self.parse_ics(large_ics_content)
-        self.assertEqual(parsed_response.serialize(), parsed_ics_content.serialize())
+        self.assertEqual(canonical_ics(response.content), canonical_ics(large_ics_content))
         # Clean up by deleting the collection
         self.delete_collection(username, password, collection)
 
     def test_concurrent_access(self):
-        import threading
-
-        def add_event(username, password, collection, filename, content):
-            self.add_ics_file(username, password, collection, filename, content)
-
         username = 'user1'
         password = 'password'
         collection = 'concurrent_access'
 
         self.create_collection(username, password, collection)
 
-        threads = []
-        for i in range(0, 5):  # Create 5 events concurrently
-            filename = f'event_{i}.ics'
-            content = f"""BEGIN:VCALENDAR
-VERSION:2.0
-BEGIN:VEVENT
-UID:uid{i}@example.com
-DTSTAMP:20200714T170000Z
-ORGANIZER;CN=User One:MAILTO:{username}@example.com
-DTSTART:20200714T170000Z
-DTEND:20200714T180000Z
-SUMMARY:Event {i}
-END:VEVENT
-END:VCALENDAR"""
-            thread = threading.Thread(target=add_event, args=(username, password, collection, filename, content))
-            threads.append(thread)
-            thread.start()
+        def add_event(i):
+            self.add_ics_file(username, password, collection, f'event_{i}.ics', concurrent_ics_contents[i])
 
-        for thread in threads:
-            thread.join()
+        # Create 5 events concurrently, map() re-raises failed assertions
+        list(self.pool.map(add_event, range(5)))
 
         # Verify all events were added
         for i in range(0, 5):
             filename = f'event_{i}.ics'
-            response = requests.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
+            response = self.session.get(f'{radicale_url}{username}/{collection}/{filename}', auth=(username, password))
             self.assertEqual(response.status_code, 200)
 
         self.delete_collection(username, password, collection)
@@ -332,20 +427,23 @@ END:VCALENDAR"""
         auth = HTTPBasicAuth(username, password)
         headers = {'Content-Type': 'application/xml'}
 
-        for i in range(10):  # Example: Create and delete 10 collections
+        def create_delete(i):
             collection_name = f'test_collection_{i}'
             collection_url = f'{base_url}{collection_name}/'
 
             # Create collection
-            create_response = requests.request('MKCOL', collection_url, data=CREATE_CALENDAR_XML, auth=auth,
-                                               headers=headers)
+            create_response = self.session.request('MKCOL', collection_url, data=CREATE_CALENDAR_XML, auth=auth,
+                                                   headers=headers)
             self.assertIn(create_response.status_code, [201, 204], f'Failed to create collection {collection_name}')
 
             # Delete collection
-            delete_response = requests.request('DELETE', collection_url, auth=auth)
+            delete_response = self.session.request('DELETE', collection_url, auth=auth)
             self.assertIn(delete_response.status_code, [200, 204, 404],
                           f'Failed to delete collection {collection_name}')
 
+        # Create and delete 10 collections, independent of each other
+        list(self.pool.map(create_delete, range(10)))
+
     def test_add_two_events_same_uid(self):
         username = 'user1'
         password = 'password'
@@ -371,7 +469,7 @@ END:VCALENDAR"""
         self.add_ics_file(username, password, collection, filename2, event_content, return_code=[409])
 
         url = f'{radicale_url}{username}/{collection}/'
-        response = requests.request('PROPFIND', url, auth=HTTPBasicAuth(username, password))
+        response = self.session.request('PROPFIND', url, auth=HTTPBasicAuth(username, password))
         self.assertEqual(response.status_code, 207)
 
         self.delete_collection(username, password, collection)
@@ -427,8 +525,8 @@ END:VCALENDAR"""]
 </C:calendar-query>'''
         headers = {'Content-Type': 'application/xml'}
         url = f'{radicale_url}{username}/{collection}/'
-        response = requests.request('REPORT', url, data=report_xml, headers=headers,
-                                    auth=HTTPBasicAuth(username, password))
+        response = self.session.request('REPORT', url, data=report_xml, headers=headers,
+                                        auth=HTTPBasicAuth(username, password))
 
         # Verify that the response contains the event with the specific summary
         self.assertIn("Event with Special Keyword", response.text)
@@ -436,6 +534,226 @@ END:VCALENDAR"""]
 
         self.delete_collection(username, password, collection)
 
+    def test_report_filters_addressbook_text_match(self):
+        username = 'user1'
+        password = 'password'
+        collection = 'test_addressbook_text_match'
+        url = f'{radicale_url}{username}/{collection}/'
+        response = self.session.request('MKCOL', url, data=CREATE_ADDRESSBOOK_XML, auth=(username, password))
+        self.assertIn(response.status_code, [201, 204])
+
+        for i, name in enumerate(['Foo Bar', 'Other Person'], start=1):
+            card = f"""BEGIN:VCARD
+VERSION:3.0
+UID:card{i}@example.com
+FN:{name}
+N:{name.split()[1]};{name.split()[0]};;;
+END:VCARD"""
+            response = self.session.put(f'{url}card{i}.vcf', data=card, headers={'Content-Type': 'text/vcard'},
+                                        auth=(username, password))
+            self.assertIn(response.status_code, [201, 204])
+
+        # text matches ignore case by default
+        report_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<CR:addressbook-query xmlns:D="DAV:" xmlns:CR="urn:ietf:params:xml:ns:carddav">
+  <D:prop>
+    <D:getetag/>
+  </D:prop>
+  <CR:filter>
+    <CR:prop-filter name="FN">
+      <CR:text-match match-type="contains">fo</CR:text-match>
+    </CR:prop-filter>
+  </CR:filter>
+</CR:addressbook-query>'''
+        multistatus = self.report(username, password, collection, report_xml)
+        hrefs = [href.rsplit('/', 1)[-1] for href in multistatus.itertext() if href.endswith('.vcf')]
+        self.assertEqual(hrefs, ['card1.vcf'])
+
+        self.delete_collection(username, password, collection)
+
+    def report(self, username, password, collection, report_xml):
+        url = f'{radicale_url}{username}/{collection}/'
+        headers = {'Content-Type': 'application/xml'}
+        response = self.session.request('REPORT', url, data=report_xml, headers=headers,
+                                        auth=HTTPBasicAuth(username, password))
+        self.assertEqual(response.status_code, 207)
+        return ET.fromstring(response.content)
+
+    def sync_collection(self, username, password, collection, token=''):
+        multistatus = self.report(username, password, collection, SYNC_COLLECTION_XML.format(token=token))
+        changes = {}
+        for response in multistatus.iterfind('{DAV:}response'):
+            href = response.findtext('{DAV:}href').rsplit('/', 1)[-1]
+            changes[href] = response.findtext('{DAV:}status') is None
+        return multistatus.findtext('{DAV:}sync-token'), changes
+
+    def test_report_filters_time_range(self):
+        username = 'user1'
+        password = 'password'
+        collection = 'test_time_range'
+        self.create_collection(username, password, collection)
+
+        # user1's event is on July 14th, the other one on July 15th
+        self.add_ics_file(username, password, collection, 'event_14.ics', ics_contents['user1'])
+        self.add_ics_file(username, password, collection, 'event_15.ics', ics_contents['user2'].replace(
+            '20200714T1', '20200715T1'))
+
+        multistatus = self.report(username, password, collection, TIME_RANGE_REPORT_XML.format(
+            start='20200715T000000Z', end='20200716T000000Z'))
+        hrefs = [href.rsplit('/', 1)[-1] for href in multistatus.itertext() if href.endswith('.ics')]
+        self.assertEqual(hrefs, ['event_15.ics'])
+
+        multistatus = self.report(username, password, collection, TIME_RANGE_REPORT_XML.format(
+            start='20200714T173000Z', end='20200715T173000Z'))
+        hrefs = [href.rsplit('/', 1)[-1] for href in multistatus.itertext() if href.endswith('.ics')]
+        self.assertEqual(sorted(hrefs), ['event_14.ics', 'event_15.ics'])
+
+        self.delete_collection(username, password, collection)
+
+    def test_sync_collection(self):
+        username = 'user1'
+        password = 'password'
+        collection = 'test_sync'
+        self.create_collection(username, password, collection)
+
+        token, changes = self.sync_collection(username, password, collection)
+        self.assertEqual(changes, {})
+
+        self.add_ics_file(username, password, collection, 'event_1.ics', concurrent_ics_contents[1])
+        self.add_ics_file(username, password, collection, 'event_2.ics', concurrent_ics_contents[2])
+        added_token, changes = self.sync_collection(username, password, collection, token)
+        self.assertEqual(changes, {'event_1.ics': True, 'event_2.ics': True})
+
+        # nothing changed since the last token
+        same_token, changes = self.sync_collection(username, password, collection, added_token)
+        self.assertEqual(same_token, added_token)
+        self.assertEqual(changes, {})
+
+        self.update_ics_file(username, password, collection, 'event_1.ics',
+                             concurrent_ics_contents[1].replace(b'SUMMARY:Event 1', b'SUMMARY:Updated Event 1'))
+        updated_token, changes = self.sync_collection(username, password, collection, added_token)
+        self.assertEqual(changes, {'event_1.ics': True})
+
+        response = self.session.delete(f'{radicale_url}{username}/{collection}/event_2.ics', auth=(username, password))
+        self.assertEqual(response.status_code, 200)
+        _, changes = self.sync_collection(username, password, collection, updated_token)
+        self.assertEqual(changes, {'event_2.ics': False})
+
+        # an old token reports everything changed since then
+        _, changes = self.sync_collection(username, password, collection, token)
+        self.assertEqual(changes, {'event_1.ics': True, 'event_2.ics': False})
+
+        self.delete_collection(username, password, collection)
+
+    def move_ics_file(self, username, password, collection, filename, to_collection, to_filename, return_code):
+        url = f'{radicale_url}{username}/{collection}/{filename}'
+        headers = {'Destination': f'{radicale_url}{username}/{to_collection}/{to_filename}', 'Overwrite': 'T'}
+        response = self.session.request('MOVE', url, headers=headers, auth=(username, password))
+        self.assertEqual(response.status_code, return_code)
+
+    def test_move_ics_file(self):
+        username = 'user1'
+        password = 'password'
+        self.create_collection(username, password, 'move_source')
+        self.create_collection(username, password, 'move_target')
+        self.add_ics_file(username, password, 'move_source', 'event.ics', ics_contents['user1'])
+        token, _ = self.sync_collection(username, password, 'move_source')
+
+        # onto a new href
+        self.move_ics_file(username, password, 'move_source', 'event.ics', 'move_source', 'moved.ics', 201)
+        response = self.session.get(f'{radicale_url}{username}/move_source/event.ics', auth=(username, password))
+        self.assertEqual(response.status_code, 404)
+        response = self.session.get(f'{radicale_url}{username}/move_source/moved.ics', auth=(username, password))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(canonical_ics(response.content), canonical_ics(ics_contents['user1'].encode()))
+        _, changes = self.sync_collection(username, password, 'move_source', token)
+        self.assertEqual(changes, {'event.ics': False, 'moved.ics': True})
+
+        # onto an existing href of the same event in another collection
+        self.add_ics_file(username, password, 'move_target', 'event.ics',
+                          ics_contents['user1'].replace('User One Event', 'Outdated Event'))
+        self.move_ics_file(username, password, 'move_source', 'moved.ics', 'move_target', 'event.ics', 204)
+        response = self.session.get(f'{radicale_url}{username}/move_target/event.ics', auth=(username, password))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(canonical_ics(response.content), canonical_ics(ics_contents['user1'].encode()))
+        response = self.session.get(f'{radicale_url}{username}/move_source/moved.ics', auth=(username, password))
+        self.assertEqual(response.status_code, 404)
+
+        self.delete_collection(username, password, 'move_source')
+        self.delete_collection(username, password, 'move_target')
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+    # a database written by the first release, opened by the current one
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            remove_files(upgrade_database_path, htpasswd_path, upgrade_config_path)
+            with contextlib.closing(sqlite3.connect(upgrade_database_path)) as connection:
+                connection.executescript(BASELINE_SCHEMA_SQL)
+                connection.execute(
+                    "INSERT INTO item VALUES ('00000000000000000000000000000006', '00000000000000000000000000000003',"
+                    " '2024-01-01 00:00:00.000000', 'event.ics', ?)", (ics_contents['user1'].encode(),))
+                connection.commit()
+            write_server_config(upgrade_config_path, upgrade_port, upgrade_database_path)
+
+            cls.session = requests.Session()
+            cls.process = start_server(upgrade_config_path, upgrade_port, cls.session)
+
+        except Exception as e:
+            cls.tearDownClass()
+            raise e
+
+    @classmethod
+    def tearDownClass(cls):
+        if hasattr(cls, 'process'):
+            cls.process.terminate()
+            cls.process.wait()
+        if hasattr(cls, 'session'):
+            cls.session.close()
+        remove_files(upgrade_database_path, htpasswd_path, upgrade_config_path)
+
+    def url(self, path=''):
+        return f'http://{radicale_host}:{upgrade_port}/user1/calendar/{path}'
+
+    def test_fetch_stored_item(self):
+        response = self.session.get(self.url('event.ics'), auth=('user1', 'password'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(canonical_ics(response.content), canonical_ics(ics_contents['user1'].encode()))
+
+    def test_stored_item_is_filtered_and_keeps_its_uid(self):
+        headers = {'Content-Type': 'application/xml'}
+        for start, end, hrefs in (('20200714T000000Z', '20200715T000000Z', ['event.ics']),
+                                  ('20200715T000000Z', '20200716T000000Z', [])):
+            with self.subTest(start=start):
+                response = self.session.request('REPORT', self.url(), headers=headers, auth=('user1', 'password'),
+                                                data=TIME_RANGE_REPORT_XML.format(start=start, end=end))
+                self.assertEqual(response.status_code, 207)
+                multistatus = ET.fromstring(response.content)
+                self.assertEqual(
+                    [href.rsplit('/', 1)[-1] for href in multistatus.itertext() if href.endswith('.ics')], hrefs)
+
+        # the uid of the stored item is known, the same event cannot be added twice
+        response = self.session.put(self.url('copy.ics'), data=ics_contents['user1'],
+                                    headers={'Content-Type': 'text/calendar'}, auth=('user1', 'password'))
+        self.assertEqual(response.status_code, 409)
+
+    def test_sync_collection(self):
+        response = self.session.request('REPORT', self.url(), data=SYNC_COLLECTION_XML.format(token=''),
+                                        headers={'Content-Type': 'application/xml'}, auth=('user1', 'password'))
+        self.assertEqual(response.status_code, 207)
+        multistatus = ET.fromstring(response.content)
+        self.assertTrue(multistatus.findtext('{DAV:}sync-token'))
+        self.assertEqual(
+            sorted(href.rsplit('/', 1)[-1] for href in multistatus.itertext() if href.endswith('.ics')),
+            ['deleted.ics', 'event.ics'])
+
+    def test_duplicate_history_is_removed(self):
+        with contextlib.closing(sqlite3.connect(upgrade_database_path)) as connection:
+            rows = connection.execute("SELECT history_etag FROM item_history WHERE name = 'deleted.ics'").fetchall()
+        self.assertEqual(rows, [('bbbb',)])
+
 
 if __name__ == '__main__':
     unittest.main()